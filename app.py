@@ -1,17 +1,22 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, send_from_directory, has_request_context
 from mexal_api import ( # Importa funzioni specifiche
     mx_call_api, get_vettori, get_shipping_address, get_dati_aggiuntivi,
-    get_payment_methods, search_articles, get_article_price, find_article_code_by_alt_code, 
+    get_payment_methods, search_articles, get_article_price, get_article_prices, get_article_groups, get_article_stock, find_article_code_by_alt_code, 
     search_articles_by_code, get_article_details, update_article_alt_code, get_all_clients,
-    get_all_shipping_addresses
+    get_all_shipping_addresses, get_shipping_address_map, prefetch_dati_aggiuntivi,
+    with_fields, mx_iter_search, mx_iter_search_in, MexalAPIError, is_mexal_available, SingleFlight, LRUCache,
+    invalidate_article_details,
+    begin_request_metrics, end_request_metrics, render_metrics_prometheus,
+    CLIENT_FIELDS, ORDER_FIELDS, ORDER_ROW_FIELDS, ORDER_KEY_FIELDS, ARTICLE_CATALOG_FIELDS
 )
 import time
 import os
 from dotenv import load_dotenv # Importa per caricare .env
 import googlemaps
 from datetime import datetime, timedelta
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 import math
+import re
 import io
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
@@ -20,8 +25,14 @@ from wtforms.validators import DataRequired
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 from pywebpush import webpush, WebPushException
 import threading 
+import pickle
+try:
+    import fcntl # Lock tra processi (solo Unix): un solo refresher per tutti i worker
+except ImportError:
+    fcntl = None
 import dropbox
 from fpdf import FPDF
 
@@ -206,6 +217,56 @@ class CalculatedRoute(db.Model):
     route_data_json = db.Column(db.Text, nullable=False)
     last_calculated = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ArticleCatalog(db.Model):
+    """ Copia locale del catalogo articoli Mexal: ricerca magazzino (FTS5) e risoluzione barcode. """
+    codice = db.Column(db.String(50), primary_key=True)
+    descrizione = db.Column(db.String(255), nullable=True)
+    descr_completa = db.Column(db.Text, nullable=True)
+    cod_alternativo = db.Column(db.String(100), nullable=True, index=True)
+    cod_grp_merc = db.Column(db.String(50), nullable=True)
+    qta_carico = db.Column(db.Float, default=0)
+    qta_scarico = db.Column(db.Float, default=0)
+    ord_cli_e = db.Column(db.Float, default=0)
+    ord_cli_sps = db.Column(db.Float, default=0)
+
+    def to_dict(self):
+        return {
+            'codice': self.codice, 'descrizione': self.descrizione,
+            'descr_completa': self.descr_completa, 'cod_alternativo': self.cod_alternativo or '',
+            'cod_grp_merc': self.cod_grp_merc or '',
+            'qta_carico': self.qta_carico, 'qta_scarico': self.qta_scarico,
+            'ord_cli_e': self.ord_cli_e, 'ord_cli_sps': self.ord_cli_sps,
+        }
+
+class SyncState(db.Model):
+    """ Ultima sincronizzazione riuscita di un archivio locale copiato da Mexal. """
+    name = db.Column(db.String(50), primary_key=True)
+    last_sync = db.Column(db.DateTime, nullable=False)
+
+# --- Metriche chiamate Mexal per richiesta ---
+@app.before_request
+def _start_mexal_metrics():
+    route = request.url_rule.rule if request.url_rule else request.path
+    begin_request_metrics(route)
+
+@app.after_request
+def _log_mexal_metrics(response):
+    summary = end_request_metrics()
+    if summary and summary['calls']:
+        print(f"Metriche Mexal [{request.method} {summary['route']}]: {summary['calls']} chiamate "
+              f"({summary['errors']} errori), {summary['seconds']:.2f}s, {summary['bytes'] / 1024:.0f} KB")
+        response.headers['X-Mexal-Calls'] = str(summary['calls'])
+        response.headers['X-Mexal-Time'] = f"{summary['seconds']:.3f}"
+    return response
+
+@app.route('/admin/metrics')
+@login_required
+def mexal_metrics():
+    """Metriche delle chiamate Mexal in formato testo Prometheus (solo admin)."""
+    if not current_user.has_role('admin'):
+        return Response("Accesso non autorizzato.\n", status=403, mimetype='text/plain')
+    return Response(render_metrics_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # --- Rotte Service Worker & VAPID Key (OK) ---
 @app.route('/sw.js')
 def service_worker():
@@ -319,6 +380,239 @@ def send_push_notification(user_id, title, body):
     print(f"Invio notifiche completato per {user_id}: {success_count} successi, {failure_count} fallimenti.")
 
 
+# --- Record immutabili dello snapshot ordini ---
+# Lo snapshot è letto da più thread (e condiviso tra worker): ordini e righe sono tuple
+# con nome, più compatte dei dict e non modificabili. I campi calcolati da una rotta
+# (stato, data formattata, vettore...) vanno in una OrderView creata per la richiesta.
+def _field_names(fields, extra=()):
+    return tuple(dict.fromkeys([f.strip() for f in fields.split(',') if f.strip()] + list(extra)))
+
+# Campi aggiunti da _enrich_order alla testata Mexal
+ORDER_ENRICHED_FIELDS = (
+    'ragione_sociale', 'telefono', 'indirizzo_effettivo', 'localita_effettiva', 'cap_effettivo',
+    'provincia_effettiva', 'telefono_effettivo', 'fonte_indirizzo', 'orario1_start', 'orario1_end',
+    'nota', 'pagamento_desc', 'righe'
+)
+
+class _RecordGetMixin:
+    __slots__ = ()
+
+    def get(self, name, default=None):
+        """Come dict.get: default se il campo non esiste o è vuoto (None)."""
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+class OrderRow(_RecordGetMixin, namedtuple('OrderRow', _field_names(ORDER_ROW_FIELDS))):
+    """Riga d'ordine nello snapshot (immutabile)."""
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(*(data.get(f) for f in cls._fields))
+
+class OrderRecord(_RecordGetMixin, namedtuple('OrderRecord', _field_names(ORDER_FIELDS, ORDER_ENRICHED_FIELDS))):
+    """Ordine arricchito nello snapshot (immutabile); 'righe' è una tupla di OrderRow."""
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        values = {f: data.get(f) for f in cls._fields}
+        values['righe'] = tuple(OrderRow.from_dict(r) for r in (data.get('righe') or ()))
+        return cls(**values)
+
+    def to_dict(self):
+        """Copia modificabile (con le righe come dict), es. per ri-arricchire o serializzare in JSON."""
+        data = self._asdict()
+        data['righe'] = [row._asdict() for row in self.righe]
+        return data
+
+class OrderView:
+    """
+    Vista di un ordine per una singola richiesta: legge dal record dello snapshot e
+    scrive i campi calcolati dalla rotta in un dizionario proprio, senza toccare la cache.
+    """
+    __slots__ = ('record', 'extra')
+
+    def __init__(self, record, **extra):
+        self.record = record
+        self.extra = extra
+
+    def __getattr__(self, name):
+        extra = object.__getattribute__(self, 'extra')
+        if name in extra:
+            return extra[name]
+        return getattr(object.__getattribute__(self, 'record'), name)
+
+    def __getitem__(self, name):
+        if name in self.extra:
+            return self.extra[name]
+        if name in self.record._fields:
+            return getattr(self.record, name)
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        self.extra[name] = value
+
+    def __contains__(self, name):
+        return name in self.extra or name in self.record._fields
+
+    def get(self, name, default=None):
+        value = self.extra[name] if name in self.extra else self.record.get(name)
+        return default if value is None else value
+
+    def to_dict(self):
+        data = self.record.to_dict()
+        data.update(self.extra)
+        return data
+
+def _enrich_order(order, client_map, payment_map, shipping_address_map, dati_aggiuntivi_map, rows):
+    """
+    Completa una testata ordine (in place) con cliente, indirizzo effettivo, orari,
+    pagamento e righe. Con shipping_address_map None l'indirizzo di spedizione viene
+    richiesto singolarmente. Restituisce True/False se l'ordine ha un indirizzo di
+    spedizione specifico (usato / non valido), None se non ne ha.
+    """
+    client_code = order.get('cod_conto')
+    client_data = client_map.get(client_code, {})
+
+    order['ragione_sociale'] = client_data.get('ragione_sociale', 'N/D')
+    order['telefono'] = client_data.get('telefono', 'N/D')
+
+    # --- LOGICA INDIRIZZO (Invariata) ---
+    shipping_address_id = order.get('cod_anag_sped')
+    effective_address = client_data.get('indirizzo', 'N/D')
+    effective_locality = client_data.get('localita', 'N/D')
+    effective_cap = client_data.get('cap', '')
+    effective_provincia = client_data.get('provincia', '')
+    effective_telefono = order['telefono']
+    shipping_details_source = "Anagrafica Cliente"
+    address_result = None
+
+    if shipping_address_id:
+        address_result = False
+        if shipping_address_map is not None:
+            shipping_address_data = shipping_address_map.get(str(shipping_address_id))
+        else:
+            shipping_address_data = get_shipping_address(shipping_address_id)
+        if shipping_address_data and isinstance(shipping_address_data, dict):
+            addr_sped = shipping_address_data.get('indirizzo')
+            loc_sped = shipping_address_data.get('localita')
+            if addr_sped and loc_sped:
+                effective_address = addr_sped
+                effective_locality = loc_sped
+                effective_cap = shipping_address_data.get('cap', effective_cap)
+                effective_provincia = shipping_address_data.get('provincia', effective_provincia)
+                effective_telefono = shipping_address_data.get('telefono1', effective_telefono)
+                shipping_details_source = f"Indirizzo Sped. ID: {shipping_address_id}"
+                address_result = True
+
+    order['indirizzo_effettivo'] = effective_address
+    order['localita_effettiva'] = effective_locality
+    order['cap_effettivo'] = effective_cap
+    order['provincia_effettiva'] = effective_provincia
+    order['telefono_effettivo'] = effective_telefono
+    order['fonte_indirizzo'] = shipping_details_source
+    # --- FINE LOGICA INDIRIZZO ---
+
+    dati_aggiuntivi = dati_aggiuntivi_map.get(client_code) or {}
+    order['orario1_start'] = dati_aggiuntivi.get('orario1start')
+    order['orario1_end'] = dati_aggiuntivi.get('orario1end')
+    order['nota'] = order.get('nota', '')
+    order['pagamento_desc'] = payment_map.get(order.get('id_pagamento'), 'N/D')
+    order['righe'] = rows
+    return address_result
+
+def _order_key(record):
+    """Chiave 'sigla:serie:numero' di una testata o riga, None se incompleta."""
+    sigla = record.get('sigla', '?'); serie = record.get('serie', '?'); numero = record.get('numero', '?')
+    if sigla == '?' or serie == '?' or numero == '?':
+        return None
+    return f"{sigla}:{serie}:{numero}"
+
+# --- Finestra di caricamento ordini ---
+# Solo gli ordini con data_documento negli ultimi ORDER_WINDOW_DAYS giorni (0 = tutti), più quelli
+# ancora in lavorazione nell'app (in picking/controllo o assegnati e non ancora consegnati) purché
+# non più vecchi di ORDER_OPEN_MAX_DAYS; gli altri si scaricano su richiesta (link diretto).
+ORDER_WINDOW_DAYS = int(os.getenv('ORDER_WINDOW_DAYS', '14'))
+ORDER_OPEN_MAX_DAYS = int(os.getenv('ORDER_OPEN_MAX_DAYS', '60'))
+ORDER_IN_PROGRESS_STATUSES = ('In Picking', 'In Controllo')
+_on_demand_orders = LRUCache('ordini_su_richiesta', int(os.getenv('ORDER_ON_DEMAND_CACHE_SIZE', '200')),
+                             ttl=int(os.getenv('ORDER_ON_DEMAND_TTL_MINUTES', '10')) * 60)
+
+def _order_window_filter(days=ORDER_WINDOW_DAYS):
+    if days <= 0:
+        return []
+    window_start = (datetime.now() - timedelta(days=days)).strftime('%Y%m%d')
+    return [{'campo': 'data_documento', 'condizione': '>=', 'valore': window_start}]
+
+def _open_order_keys():
+    """
+    Chiavi degli ordini che restano in cache anche fuori finestra: quelli in picking o in
+    controllo e quelli assegnati a un vettore la cui consegna non è ancora chiusa.
+    Lo stato di default 'Da Lavorare' non conta: viene creato per ogni ordine caricato.
+    """
+    try:
+        keys = {key for (key,) in db.session.query(PickingState.order_key)
+                .filter(PickingState.status.in_(ORDER_IN_PROGRESS_STATUSES))}
+        keys |= {key for (key,) in db.session.query(LogisticsAssignment.order_key)
+                 .outerjoin(DeliveryEvent, DeliveryEvent.order_key == LogisticsAssignment.order_key)
+                 .filter(LogisticsAssignment.autista_codice.isnot(None), LogisticsAssignment.autista_codice != '')
+                 .filter(db.or_(DeliveryEvent.end_time_str.is_(None), DeliveryEvent.end_time_str == ''))}
+        return keys
+    except Exception as e:
+        print(f"ERRORE [_open_order_keys]: {e}")
+        return set()
+
+def fetch_order_on_demand(order_key):
+    """
+    Scarica e arricchisce un singolo ordine non presente nello snapshot (es. fuori finestra).
+    Restituisce un OrderRecord o None se l'ordine non esiste o Mexal non risponde.
+    """
+    parts = order_key.split(':')
+    if len(parts) != 3:
+        return None
+    filtri = [{'campo': campo, 'condizione': '=', 'valore': int(valore) if valore.isdigit() else valore}
+              for campo, valore in zip(('sigla', 'serie', 'numero'), parts)]
+    try:
+        headers = [o for o in mx_iter_search('risorse/documenti/ordini-clienti/ricerca', filtri=filtri, fields=ORDER_FIELDS)
+                   if _order_key(o) == order_key]
+        if not headers:
+            return None
+        order = headers[0]
+        rows = [r for r in mx_iter_search('risorse/documenti/ordini-clienti/righe/ricerca', filtri=filtri, fields=ORDER_ROW_FIELDS)
+                if _order_key(r) == order_key]
+        snapshot = _cache["snapshot"]
+        client_map = {}
+        client_code = order.get('cod_conto')
+        if snapshot and client_code in snapshot['client_map']:
+            client_map[client_code] = snapshot['client_map'][client_code]
+        elif client_code:
+            client_map = {c['codice']: c for c in mx_iter_search_in('risorse/clienti/ricerca', 'codice', [client_code], fields=CLIENT_FIELDS)}
+    except MexalAPIError as e:
+        print(f"ERRORE [fetch_order_on_demand]: {order_key}: {e}")
+        return None
+
+    _enrich_order(order, client_map, get_payment_methods() or {}, None, prefetch_dati_aggiuntivi([client_code]), rows)
+    print(f"Ordine {order_key} fuori dalla cache scaricato su richiesta.")
+    return OrderRecord.from_dict(order)
+
+def get_order_record(order_key):
+    """Un ordine dallo snapshot o, se non c'è (es. fuori finestra), scaricato su richiesta e tenuto in cache."""
+    orders_map, _ = get_cached_order_data()
+    if orders_map and order_key in orders_map:
+        return orders_map[order_key]
+    record = _on_demand_orders.get(order_key)
+    if record is None:
+        record = fetch_order_on_demand(order_key)
+        if record is not None:
+            _on_demand_orders.set(order_key, record)
+    return record
+
+def _flash_if_request(message, category):
+    """flash() solo dentro una richiesta: load_all_data() gira anche nel refresher in background."""
+    if has_request_context():
+        flash(message, category)
+
 def load_all_data():
     """
     Carica (o ricarica) dati da API Mexal, dando priorità
@@ -326,45 +620,78 @@ def load_all_data():
     """
     print("--- Inizio caricamento di massa dei dati dall'API (con priorità indirizzi spedizione) ---")
 
-    # 1. Carica Clienti
-    clients_response = mx_call_api('risorse/clienti/ricerca', method='POST', data={'filtri': []})
-    if not clients_response or not isinstance(clients_response.get('dati'), list): 
-        print("Errore CRITICO: Impossibile caricare i dati clienti.")
-        flash("Errore nel recupero dei dati clienti.", "danger")
+    # 1. Carica Clienti (a pagine, la mappa si costruisce mentre arrivano i dati)
+    client_map = {}
+    try:
+        for client in mx_iter_search('risorse/clienti/ricerca', fields=CLIENT_FIELDS):
+            if 'codice' in client:
+                client_map[client['codice']] = client
+    except MexalAPIError as e:
+        print(f"Errore CRITICO: Impossibile caricare i dati clienti ({e}).")
+        _flash_if_request("Errore nel recupero dei dati clienti.", "danger")
         return None, None # Restituisce None per ordini e mappa
-    client_map = {client['codice']: client for client in clients_response['dati'] if 'codice' in client}
     print(f"Caricati {len(client_map)} clienti.")
     
     # 2. Carica Metodi Pagamento
     payment_map = get_payment_methods()
     if not payment_map: 
-        flash("Attenzione: Non è stato possibile caricare i metodi di pagamento.", "warning")
+        _flash_if_request("Attenzione: Non è stato possibile caricare i metodi di pagamento.", "warning")
         payment_map = {}
     print(f"Caricati {len(payment_map)} metodi di pagamento.")
+
+    # 2b. Carica TUTTI gli indirizzi di spedizione in una sola chiamata (evita N+1)
+    shipping_address_map = get_shipping_address_map()
+    if shipping_address_map is None:
+        print("Attenzione: Caricamento massivo indirizzi spedizione fallito. Uso chiamate singole.")
+    else:
+        print(f"Caricati {len(shipping_address_map)} indirizzi di spedizione.")
     
-    # 3. Carica Testate Ordini
-    orders_response = mx_call_api('risorse/documenti/ordini-clienti/ricerca', method='POST', data={'filtri': []})
-    if not orders_response or not isinstance(orders_response.get('dati'), list): 
-        print("Errore CRITICO: Impossibile caricare gli ordini.")
-        flash("Errore nel recupero degli ordini.", "danger")
+    # 3. Carica Testate Ordini (finestra ORDER_WINDOW_DAYS + ordini più vecchi ancora in lavorazione, entro ORDER_OPEN_MAX_DAYS)
+    window_filter = _order_window_filter()
+    try:
+        orders = list(mx_iter_search('risorse/documenti/ordini-clienti/ricerca', filtri=window_filter, fields=ORDER_FIELDS))
+        if window_filter:
+            loaded_keys = {_order_key(o) for o in orders}
+            open_keys = _open_order_keys() - loaded_keys
+            if open_keys:
+                orders.extend(
+                    o for o in mx_iter_search_in('risorse/documenti/ordini-clienti/ricerca', 'numero',
+                                                 [int(numero) for numero in (key.split(':')[2] for key in open_keys) if numero.isdigit()],
+                                                 fields=ORDER_FIELDS, filtri=_order_window_filter(ORDER_OPEN_MAX_DAYS))
+                    if _order_key(o) in open_keys
+                )
+    except MexalAPIError as e:
+        print(f"Errore CRITICO: Impossibile caricare gli ordini ({e}).")
+        _flash_if_request("Errore nel recupero degli ordini.", "danger")
         return None, None
-    orders = orders_response['dati']
-    print(f"Caricate {len(orders)} testate ordini.")
+    print(f"Caricate {len(orders)} testate ordini" + (f" (dal {window_filter[0]['valore']} + in lavorazione)." if window_filter else "."))
     
-    # 4. Carica Righe Ordini
-    rows_response = mx_call_api('risorse/documenti/ordini-clienti/righe/ricerca', method='POST', data={'filtri': []})
+    # 4. Carica Righe Ordini (raggruppate per ordine man mano che arrivano)
+    # Con la finestra attiva si scaricano solo le righe degli ordini caricati (ricerca 'in' sul numero)
     rows_map = defaultdict(list)
-    if rows_response and isinstance(rows_response.get('dati'), list):
-        row_count = 0
-        for row in rows_response['dati']:
-            sigla = row.get('sigla', '?'); serie = row.get('serie', '?'); numero = row.get('numero', '?')
-            if sigla != '?' and serie != '?' and numero != '?': 
-                rows_map[f"{sigla}:{serie}:{numero}"].append(row)
+    row_count = 0
+    try:
+        if window_filter:
+            order_keys = {_order_key(o) for o in orders}
+            rows_iter = mx_iter_search_in('risorse/documenti/ordini-clienti/righe/ricerca', 'numero',
+                                          [o.get('numero') for o in orders], fields=ORDER_ROW_FIELDS)
+        else:
+            order_keys = None
+            rows_iter = mx_iter_search('risorse/documenti/ordini-clienti/righe/ricerca', fields=ORDER_ROW_FIELDS)
+        for row in rows_iter:
+            row_key = _order_key(row)
+            if row_key and (order_keys is None or row_key in order_keys):
+                rows_map[row_key].append(row)
                 row_count += 1
         print(f"Caricate {row_count} righe ordini.")
-    else: 
-        print("Attenzione: Non è stato possibile caricare le righe degli ordini.")
-        flash("Attenzione: Errore caricamento righe.", "warning")
+    except MexalAPIError as e:
+        print(f"Attenzione: Non è stato possibile caricare le righe degli ordini ({e}).")
+        _flash_if_request("Attenzione: Errore caricamento righe.", "warning")
+        rows_map = defaultdict(list) # Niente righe parziali: meglio ordini senza righe che righe mancanti
+
+    # 4b. Prefetch dati aggiuntivi (orari consegna): una chiamata per cliente distinto, in parallelo
+    dati_aggiuntivi_map = prefetch_dati_aggiuntivi(order.get('cod_conto') for order in orders)
+    print(f"Caricati dati aggiuntivi per {len(dati_aggiuntivi_map)} clienti distinti.")
 
     # 5. Assembla i dati e Sincronizza il DB
     # Manteniamo una mappa degli ordini in memoria per questa richiesta (ma non nello store globale)
@@ -373,6 +700,7 @@ def load_all_data():
     processed_count = 0
     address_fetch_errors = 0
     specific_address_used_count = 0
+    address_lookups = 0
     new_states_created = 0
 
     # Recupera tutti gli stati esistenti in una sola query
@@ -393,55 +721,16 @@ def load_all_data():
             new_states_created += 1
         # --- Fine Sincronizzazione ---
 
-        client_code = order.get('cod_conto')
-        client_data = client_map.get(client_code, {})
-
-        order['ragione_sociale'] = client_data.get('ragione_sociale', 'N/D')
-        order['telefono'] = client_data.get('telefono', 'N/D')
-
-        # --- LOGICA INDIRIZZO (Invariata) ---
-        shipping_address_id = order.get('cod_anag_sped')
-        effective_address = client_data.get('indirizzo', 'N/D')
-        effective_locality = client_data.get('localita', 'N/D')
-        effective_cap = client_data.get('cap', '')
-        effective_provincia = client_data.get('provincia', '')
-        effective_telefono = order['telefono']
-        shipping_details_source = "Anagrafica Cliente"
-
-        if shipping_address_id:
-            shipping_address_data = get_shipping_address(shipping_address_id)
-            if shipping_address_data and isinstance(shipping_address_data, dict):
-                addr_sped = shipping_address_data.get('indirizzo')
-                loc_sped = shipping_address_data.get('localita')
-                if addr_sped and loc_sped:
-                    effective_address = addr_sped
-                    effective_locality = loc_sped
-                    effective_cap = shipping_address_data.get('cap', effective_cap)
-                    effective_provincia = shipping_address_data.get('provincia', effective_provincia)
-                    effective_telefono = shipping_address_data.get('telefono1', effective_telefono)
-                    shipping_details_source = f"Indirizzo Sped. ID: {shipping_address_id}"
-                    specific_address_used_count += 1
-                else:
-                    address_fetch_errors += 1
+        address_result = _enrich_order(order, client_map, payment_map, shipping_address_map,
+                                       dati_aggiuntivi_map, rows_map.get(order_key, []))
+        if address_result is not None:
+            address_lookups += 1
+            if address_result:
+                specific_address_used_count += 1
             else:
                 address_fetch_errors += 1
-        
-        order['indirizzo_effettivo'] = effective_address
-        order['localita_effettiva'] = effective_locality
-        order['cap_effettivo'] = effective_cap
-        order['provincia_effettiva'] = effective_provincia
-        order['telefono_effettivo'] = effective_telefono
-        order['fonte_indirizzo'] = shipping_details_source
-        # --- FINE LOGICA INDIRIZZO ---
-
-        dati_aggiuntivi = get_dati_aggiuntivi(client_code)
-        order['orario1_start'] = dati_aggiuntivi.get('orario1start')
-        order['orario1_end'] = dati_aggiuntivi.get('orario1end')
-        order['nota'] = order.get('nota', '')
-        order['pagamento_desc'] = payment_map.get(order.get('id_pagamento'), 'N/D')
-        order['righe'] = rows_map.get(order_key, [])
-
-        orders_data_map[order_key] = order # Costruisci la mappa
+
+        orders_data_map[order_key] = OrderRecord.from_dict(order) # Costruisci la mappa (record immutabili)
         processed_count += 1
 
     # Commit di tutti i nuovi stati creati in una sola transazione
@@ -451,98 +740,683 @@ def load_all_data():
     except Exception as e:
         db.session.rollback()
         print(f"ERRORE CRITICO durante il commit dei nuovi stati: {e}")
-        flash("Errore nel salvataggio dei nuovi stati ordine. Riprovare.", "danger")
+        _flash_if_request("Errore nel salvataggio dei nuovi stati ordine. Riprovare.", "danger")
         return None, None
 
     print(f"--- Caricamento completato. {processed_count} ordini in cache. Usati {specific_address_used_count} indirizzi sped. specifici ({address_fetch_errors} errori). ---")
+    if shipping_address_map is not None and address_lookups > 0:
+        print(f"Indirizzi spedizione: {address_lookups} ricerche risolte con 1 chiamata massiva ({address_lookups - 1} chiamate Mexal risparmiate).")
     if address_fetch_errors > 0:
-         flash(f"Attenzione: Impossibile recuperare o validare {address_fetch_errors} indirizzi di spedizione. Usato indirizzo cliente.", "warning")
+         _flash_if_request(f"Attenzione: Impossibile recuperare o validare {address_fetch_errors} indirizzi di spedizione. Usato indirizzo cliente.", "warning")
     
     # Restituisce la mappa degli ordini e la mappa dei clienti
     return orders_data_map, client_map
 
 
 # --- Cache Semplice per i dati (sostituisce app_data_store["orders"]) ---
-# Mantiene i dati in memoria per 10 minuti per ridurre le chiamate API
+# Lo snapshot ordini viene aggiornato in background e sostituito in blocco:
+# le richieste leggono sempre lo snapshot corrente senza aspettare Mexal.
 _cache = {
-    "orders_map": None,
-    "client_map": None,
-    "last_load_time": None
+    "snapshot": None,             # {'orders_map', 'client_map', 'loaded_at'}: sostituito in blocco, mai modificato
+    "last_sync_time": None,       # Riferimento 'data_ult_mod' per la prossima sync delta
+    "last_full_load": None,       # Ultimo load_all_data() completo
+    "last_deletion_check": None   # Ultimo controllo degli ordini eliminati su Mexal
 }
-_article_details_cache = {}
-CACHE_DURATION = timedelta(minutes=10) # Cache valida per 10 minuti
+# Gruppi merceologici per codice articolo: limitata, indipendente dalla cache ordini
+_article_group_cache = LRUCache('article_groups', int(os.getenv('ARTICLE_GROUP_CACHE_SIZE', '5000')),
+                                ttl=int(os.getenv('ARTICLE_GROUP_TTL_MINUTES', '360')) * 60)
+CACHE_DURATION = timedelta(minutes=10) # Oltre questa età lo snapshot va aggiornato prima di usarlo (se il refresher è fermo)
+# Il refresher in background aggiorna lo snapshot ben prima della scadenza
+ORDER_REFRESH_INTERVAL = timedelta(seconds=int(os.getenv('ORDER_REFRESH_SECONDS', '120')))
+ORDER_REFRESHER_ENABLED = os.getenv('ORDER_REFRESHER_ENABLED', '1') == '1'
+ORDER_REFRESH_POLL_SECONDS = 5 # Ogni quanto il refresher controlla le richieste degli altri worker
+# Ricaricamento completo periodico (riallinea anche ciò che il delta non vede, es. indirizzi)
+ORDER_FULL_RELOAD_INTERVAL = timedelta(minutes=int(os.getenv('ORDER_FULL_RELOAD_MINUTES', '240')))
+# Il delta non vede le cancellazioni: ogni tanto si confrontano le sole chiavi degli ordini
+ORDER_DELETION_CHECK_INTERVAL = timedelta(minutes=int(os.getenv('ORDER_DELETION_CHECK_MINUTES', '30')))
+# Generazioni di cui lo snapshot conserva le chiavi cambiate (aggiornamento delle pagine senza ricaricarle)
+ORDER_CHANGE_HISTORY = int(os.getenv('ORDER_CHANGE_HISTORY', '200'))
+
+_order_reload_flight = SingleFlight() # Un solo aggiornamento dello snapshot alla volta per processo
+_order_sync_lock = threading.Lock()   # Serializza caricamenti completi e sync delta sulla cache
+_order_refresher = {"thread": None, "wakeup": threading.Event(), "lock": threading.Lock()}
+
+# --- Snapshot condiviso tra i worker gunicorn ---
+# Un solo processo (quello che ottiene il lock su file) aggiorna lo snapshot da Mexal e lo
+# pubblica in un file pickle (sostituzione atomica); gli altri worker lo rileggono quando
+# il file cambia, senza chiamare Mexal.
+ORDER_SNAPSHOT_PATH = os.getenv('ORDER_SNAPSHOT_PATH', os.path.join(app.instance_path, 'orders_snapshot.pickle'))
+# Il file serve anche per la ripartenza: all'avvio si usa l'ultimo snapshot (se non troppo vecchio)
+ORDER_WARM_START_MAX_AGE = timedelta(hours=int(os.getenv('ORDER_WARM_START_MAX_HOURS', '48')))
+# Cambia con la struttura dei record: i file scritti da versioni con altri campi vengono ignorati
+ORDER_SNAPSHOT_FORMAT = (4, OrderRecord._fields, OrderRow._fields)
+# Riferimenti di sync e ora dell'ultimo controllo: riscritti a ogni giro, lo snapshot solo se cambia
+ORDER_SYNC_MARKS_PATH = f"{ORDER_SNAPSHOT_PATH}.marks"
+ORDER_REFRESHER_LOCK_PATH = os.path.join(app.instance_path, 'orders_refresher.lock')
+ORDER_REFRESH_REQUEST_PATH = os.path.join(app.instance_path, 'orders_refresh.request')
+_shared_snapshot = {"mtime_ns": None, "marks_mtime_ns": None, "lock_file": None, "leader_pid": None, "last_leader_attempt": 0.0,
+                    "reload_lock": threading.Lock()}
+
+def _is_refresher_leader():
+    return _shared_snapshot["leader_pid"] == os.getpid()
+
+def _try_become_refresher_leader():
+    """Prova (senza attendere) a diventare il processo che aggiorna lo snapshot. Senza fcntl ogni processo lo è."""
+    if _is_refresher_leader():
+        return True
+    if fcntl is None:
+        _shared_snapshot["leader_pid"] = os.getpid()
+        return True
+    if time.time() - _shared_snapshot["last_leader_attempt"] < 10:
+        return False
+    _shared_snapshot["last_leader_attempt"] = time.time()
+    lock_file = open(ORDER_REFRESHER_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _shared_snapshot["lock_file"] = lock_file # Resta aperto: il lock vale finché il processo vive
+    _shared_snapshot["leader_pid"] = os.getpid()
+    print(f"Processo {os.getpid()}: aggiorna lo snapshot ordini per tutti i worker.")
+    return True
+
+def _write_pickle_atomic(path, payload):
+    """Scrive payload su file temporaneo e lo sostituisce in blocco (chi legge non vede file a metà)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return os.stat(path).st_mtime_ns
+    except Exception as e:
+        print(f"ERRORE [_write_pickle_atomic]: {path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
 
-def get_cached_order_data():
+def _read_pickle(path, known_mtime_ns):
+    """(payload, mtime_ns) se il file è cambiato da known_mtime_ns, altrimenti (None, None)."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, None
+    if mtime_ns == known_mtime_ns:
+        return None, None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f), mtime_ns
+    except Exception as e:
+        print(f"ERRORE [_read_pickle]: {path}: {e}")
+        return None, None
+
+def _write_shared_snapshot(changed=True):
     """
-    Funzione helper che gestisce il caricamento e il caching dei dati
-    degli ordini e dei clienti. Sostituisce la lettura da app_data_store.
+    Pubblica lo snapshot nel file condiviso solo se i dati sono cambiati; i riferimenti di
+    sync e l'ora dell'ultimo controllo (che cambiano a ogni giro) vanno nel piccolo file
+    ORDER_SYNC_MARKS_PATH, così i worker non rileggono tutto lo snapshot a ogni sync a vuoto.
     """
-    now = datetime.now()
-    if _cache["orders_map"] and _cache["last_load_time"] and (now - _cache["last_load_time"] < CACHE_DURATION):
-        print("Dati ordini letti dalla cache (valida).")
-        return _cache["orders_map"], _cache["client_map"]
-    
-    print("Cache scaduta o vuota. Ricarico i dati da Mexal...")
-    orders_map, client_map = load_all_data() # Questa funzione ora popola il DB
-    
-    if orders_map is not None:
-        _cache["orders_map"] = orders_map
-        _cache["client_map"] = client_map
-        _cache["last_load_time"] = now
-        print("Cache ordini aggiornata.")
-    else:
-        print("Caricamento dati fallito. La cache non è stata aggiornata.")
-        # Restituisce la cache vecchia se disponibile, altrimenti None
-        return _cache["orders_map"], _cache["client_map"] 
-        
-    return orders_map, client_map
+    snapshot = _cache["snapshot"]
+    if changed or _shared_snapshot["mtime_ns"] is None:
+        mtime_ns = _write_pickle_atomic(ORDER_SNAPSHOT_PATH, {'format': ORDER_SNAPSHOT_FORMAT, 'snapshot': snapshot})
+        if mtime_ns is None:
+            return
+        _shared_snapshot["mtime_ns"] = mtime_ns
+    _shared_snapshot["marks_mtime_ns"] = _write_pickle_atomic(ORDER_SYNC_MARKS_PATH, {
+        'version': snapshot['version'],
+        'loaded_at': snapshot['loaded_at'],
+        'last_sync_time': _cache["last_sync_time"],
+        'last_full_load': _cache["last_full_load"],
+        'last_deletion_check': _cache["last_deletion_check"],
+    })
+
+def _load_shared_sync_marks():
+    """Applica i riferimenti di sync pubblicati, solo se riferiti allo snapshot in memoria."""
+    marks, mtime_ns = _read_pickle(ORDER_SYNC_MARKS_PATH, _shared_snapshot["marks_mtime_ns"])
+    snapshot = _cache["snapshot"]
+    if not isinstance(marks, dict) or snapshot is None or marks.get('version') != snapshot['version']:
+        return # Snapshot non ancora riletto: si riprova al prossimo controllo
+    _shared_snapshot["marks_mtime_ns"] = mtime_ns
+    _cache["last_sync_time"] = marks.get('last_sync_time')
+    _cache["last_full_load"] = marks.get('last_full_load')
+    _cache["last_deletion_check"] = marks.get('last_deletion_check')
+    if marks.get('loaded_at') and marks['loaded_at'] != snapshot['loaded_at']:
+        _cache["snapshot"] = dict(snapshot, loaded_at=marks['loaded_at']) # Stessi dati, controllati più di recente
+
+def _shared_checked_at(snapshot):
+    """Ultimo controllo su Mexal dello snapshot su disco (dal file dei riferimenti, se è il suo)."""
+    marks, _ = _read_pickle(ORDER_SYNC_MARKS_PATH, None)
+    if isinstance(marks, dict) and marks.get('version') == snapshot['version'] and marks.get('loaded_at'):
+        return marks['loaded_at']
+    return snapshot['loaded_at']
+
+def _load_shared_snapshot():
+    """
+    Rilegge il file condiviso (anche all'avvio, per la ripartenza a caldo) se è cambiato
+    dall'ultima lettura, poi i riferimenti di sync. Restituisce True se lo snapshot è stato sostituito.
+    Sotto lock: un solo thread per worker legge il file nuovo, gli altri trovano l'mtime aggiornato
+    e tengono lo stesso orders_map (e quindi gli stessi indici).
+    """
+    with _shared_snapshot["reload_lock"]:
+        payload, mtime_ns = _read_pickle(ORDER_SNAPSHOT_PATH, _shared_snapshot["mtime_ns"])
+        replaced = False
+        if payload is not None:
+            _shared_snapshot["mtime_ns"] = mtime_ns
+            if not isinstance(payload, dict) or payload.get('format') != ORDER_SNAPSHOT_FORMAT or not payload.get('snapshot'):
+                print("Snapshot ordini su disco in un formato non compatibile: ignorato.")
+            elif _cache["snapshot"] is None and datetime.now() - _shared_checked_at(payload['snapshot']) > ORDER_WARM_START_MAX_AGE:
+                print(f"Snapshot ordini su disco troppo vecchio ({_shared_checked_at(payload['snapshot']):%d/%m %H:%M}): ignorato.")
+            else:
+                _cache["snapshot"] = payload['snapshot']
+                _shared_snapshot["marks_mtime_ns"] = None # Riapplica i riferimenti al nuovo snapshot
+                replaced = True
+        _load_shared_sync_marks()
+        return replaced
+
+def _request_shared_refresh(full=False):
+    """Da un worker non refresher: chiede al refresher un aggiornamento al prossimo controllo."""
+    try:
+        with open(ORDER_REFRESH_REQUEST_PATH, 'w') as f:
+            f.write('full' if full else 'delta')
+    except OSError as e:
+        print(f"ERRORE [_request_shared_refresh]: {e}")
 
-# --- Polling Route (Modificato per invalidare la cache) ---
-@app.route('/check-updates')
-@login_required
-def check_updates():
+def _pop_shared_refresh_request():
+    """Restituisce None, 'delta' o 'full' e consuma la richiesta pendente."""
+    try:
+        with open(ORDER_REFRESH_REQUEST_PATH) as f:
+            kind = f.read().strip() or 'delta'
+        os.remove(ORDER_REFRESH_REQUEST_PATH)
+        return kind
+    except OSError:
+        return None
+
+def _build_order_indexes(orders_map):
     """
-    Controlla se ci sono state modifiche su Mexal.
-    Se rileva modifiche, invalida la cache in memoria.
+    Indici secondari dello snapshot (tuple, come i record):
+    - 'sorted_keys': tutte le chiavi per data documento decrescente
+    - 'by_day': giorno del mese ('DD') -> chiavi, stesso ordinamento
+    - 'by_client': cod_conto -> chiavi
+    - 'by_article': codice_articolo -> coppie (chiave ordine, id_riga)
     """
-    last_load = _cache.get("last_load_time")
+    sorted_keys = sorted(orders_map, key=lambda key: orders_map[key].get('data_documento', '0'), reverse=True)
+    by_day, by_client, by_article = defaultdict(list), defaultdict(list), defaultdict(list)
+    for key in sorted_keys:
+        order = orders_map[key]
+        data_documento = order.get('data_documento')
+        if isinstance(data_documento, str) and len(data_documento) == 8:
+            by_day[data_documento[6:8]].append(key)
+        if order.get('cod_conto'):
+            by_client[order.cod_conto].append(key)
+        for row in order.righe:
+            if row.get('codice_articolo'):
+                by_article[row.codice_articolo].append((key, row.get('id_riga')))
+    return {
+        'sorted_keys': tuple(sorted_keys),
+        'by_day': {day: tuple(keys) for day, keys in by_day.items()},
+        'by_client': {code: tuple(keys) for code, keys in by_client.items()},
+        'by_article': {code: tuple(refs) for code, refs in by_article.items()},
+    }
 
-    if not last_load or not isinstance(last_load, datetime):
-        print("Polling: Dati mai caricati, forzo aggiornamento.")
-        return jsonify({'new_data': True})
+def get_order_indexes(orders_map):
+    """Indici dello snapshot a cui appartiene orders_map (ricostruiti se non corrispondono)."""
+    snapshot = _cache["snapshot"]
+    if snapshot and snapshot['orders_map'] is orders_map and snapshot.get('indexes'):
+        return snapshot['indexes']
+    return _build_order_indexes(orders_map)
 
-    try:
-        last_load_str = last_load.strftime('%Y%m%d %H%M%S')
-    except Exception as e:
-        print(f"Polling: Errore formattazione last_load_time ({last_load}): {e}. Forzo aggiornamento.")
-        _cache["orders_map"] = None
-        _cache["last_load_time"] = None
-        return jsonify({'new_data': True})
+def _publish_snapshot(orders_map, client_map, loaded_at, changed=True, changed_keys=None, **sync_marks):
+    """
+    Sostituisce lo snapshot con un'unica assegnazione: chi legge vede il vecchio o il nuovo,
+    mai un misto. 'generation' aumenta solo quando i dati cambiano (confronto lato browser);
+    'version' ('lineage-generation') la rende univoca anche tra snapshot ripartiti da zero.
+    changed_keys: chiavi ordine cambiate rispetto alla generazione precedente (None = tutto,
+    es. primo caricamento), conservate in 'changes' per le ultime ORDER_CHANGE_HISTORY generazioni.
+    sync_marks aggiorna i riferimenti di sync (last_sync_time, ...) pubblicati insieme ai dati.
+    """
+    previous = _cache["snapshot"]
+    generation = (previous['generation'] if previous else 0) + (1 if changed or not previous else 0)
+    lineage = previous['lineage'] if previous else format(int(time.time()), 'x')
+    # Indici ricostruiti solo se i dati cambiano (pochi ms anche con migliaia di ordini)
+    indexes = previous['indexes'] if previous and not changed and previous.get('indexes') else _build_order_indexes(orders_map)
+    if previous and not changed:
+        changes = previous['changes'] # Stessa generazione: stesse modifiche
+    else:
+        entry = (generation, tuple(sorted(changed_keys)) if previous and changed_keys is not None else None)
+        changes = ((previous['changes'] if previous else ()) + (entry,))[-ORDER_CHANGE_HISTORY:]
+    _cache.update(sync_marks)
+    _cache["snapshot"] = {'orders_map': orders_map, 'client_map': client_map, 'indexes': indexes,
+                          'loaded_at': loaded_at, 'generation': generation, 'lineage': lineage,
+                          'version': f"{lineage}-{generation}", 'changes': changes}
+    if _is_refresher_leader() or not ORDER_REFRESHER_ENABLED:
+        _write_shared_snapshot(changed) # Anche con il refresher disattivato: serve per la ripartenza
+
+def _parse_order_version(version):
+    """'lineage-generation' -> (lineage, generation); (None, None) se non valida."""
+    lineage, _, generation = str(version or '').rpartition('-')
+    return (lineage, int(generation)) if lineage and generation.isdigit() else (None, None)
+
+def get_order_changes_since(snapshot, version):
+    """
+    Chiavi degli ordini cambiati o rimossi dopo la versione indicata (vuoto se è quella
+    corrente). None se non ricostruibili: versione di un altro snapshot, più vecchia della
+    cronologia conservata o con un ricaricamento completo in mezzo.
+    """
+    lineage, generation = _parse_order_version(version)
+    if lineage != snapshot['lineage'] or generation > snapshot['generation']:
+        return None
+    newer = [keys for gen, keys in snapshot['changes'] if gen > generation]
+    if len(newer) != snapshot['generation'] - generation or any(keys is None for keys in newer):
+        return None
+    return set().union(*newer)
+
+def get_order_snapshot_age():
+    """Età dello snapshot ordini corrente (timedelta), None se non ancora caricato."""
+    snapshot = _cache["snapshot"]
+    return datetime.now() - snapshot['loaded_at'] if snapshot else None
+
+def _is_cache_valid(now):
+    snapshot = _cache["snapshot"]
+    return bool(snapshot and now - snapshot['loaded_at'] < CACHE_DURATION)
+
+def sync_orders_delta():
+    """
+    Applica alla cache solo le testate, righe e clienti modificati su Mexal dopo
+    l'ultima sincronizzazione ('data_ult_mod'), ri-arricchendo solo gli ordini coinvolti.
+    Ogni ORDER_DELETION_CHECK_INTERVAL rimuove anche gli ordini eliminati.
+    Restituisce l'insieme delle chiavi ordine cambiate o rimosse, None se la sync fallisce.
+    """
+    with _order_sync_lock:
+        snapshot, since = _cache["snapshot"], _cache["last_sync_time"]
+        if snapshot is None or since is None:
+            return None
+        orders_map, client_map = snapshot['orders_map'], snapshot['client_map']
+
+        sync_started = datetime.now()
+        filtri = [{'campo': 'data_ult_mod', 'condizione': '>', 'valore': since.strftime('%Y%m%d %H%M%S')}]
+        try:
+            changed_headers = {}
+            window_filter = _order_window_filter()
+            window_start = window_filter[0]['valore'] if window_filter else ''
+            for order in mx_iter_search('risorse/documenti/ordini-clienti/ricerca', filtri=filtri, fields=ORDER_FIELDS):
+                key = _order_key(order)
+                # Ordini vecchi modificati entrano solo se già in cache (la finestra non si allarga)
+                if key and (key in orders_map or str(order.get('data_documento') or '') >= window_start):
+                    changed_headers[key] = order
+            changed_row_keys = {
+                _order_key(row) for row in
+                mx_iter_search('risorse/documenti/ordini-clienti/righe/ricerca', filtri=filtri, fields=ORDER_KEY_FIELDS)
+            } - {None}
+            changed_clients = {
+                c['codice']: c for c in mx_iter_search('risorse/clienti/ricerca', filtri=filtri, fields=CLIENT_FIELDS)
+                if c.get('codice')
+            }
+        except MexalAPIError as e:
+            print(f"ERRORE [sync_orders_delta]: {e}")
+            return None
+
+        deleted_keys = set()
+        check_deletions = not _cache["last_deletion_check"] or sync_started - _cache["last_deletion_check"] >= ORDER_DELETION_CHECK_INTERVAL
+        if check_deletions:
+            try:
+                # Solo le chiavi in cache (ricerca 'in' sul numero), non tutto lo storico
+                current_keys = {_order_key(o) for o in mx_iter_search_in('risorse/documenti/ordini-clienti/ricerca', 'numero',
+                                                                         [o.get('numero') for o in orders_map.values()], fields=ORDER_KEY_FIELDS)}
+                deleted_keys = set(orders_map) - current_keys
+            except MexalAPIError as e:
+                print(f"Attenzione [sync_orders_delta]: Controllo ordini eliminati non riuscito ({e}).")
+                check_deletions = False
+
+        known_keys = set(orders_map) | set(changed_headers)
+        affected = set(changed_headers) | (changed_row_keys & known_keys)
+        by_client = get_order_indexes(orders_map)['by_client']
+        affected |= {key for code in changed_clients for key in by_client.get(code, ())}
+        affected -= deleted_keys
+
+        if affected or deleted_keys:
+            # Righe complete degli ordini nuovi o con righe cambiate (copre righe aggiunte ed eliminate)
+            row_keys_to_fetch = (changed_row_keys | (set(changed_headers) - set(orders_map))) & affected
+            new_client_map = dict(client_map)
+            new_client_map.update(changed_clients)
+            try:
+                fetched_rows = defaultdict(list)
+                numeri = [changed_headers.get(key, orders_map.get(key, {})).get('numero') for key in row_keys_to_fetch]
+                for row in mx_iter_search_in('risorse/documenti/ordini-clienti/righe/ricerca', 'numero', numeri, fields=ORDER_ROW_FIELDS):
+                    if _order_key(row) in row_keys_to_fetch:
+                        fetched_rows[_order_key(row)].append(row)
+                missing_clients = {changed_headers[key].get('cod_conto') for key in changed_headers if key in affected} - set(new_client_map)
+                for client in mx_iter_search_in('risorse/clienti/ricerca', 'codice', missing_clients, fields=CLIENT_FIELDS):
+                    new_client_map[client['codice']] = client
+            except MexalAPIError as e:
+                print(f"ERRORE [sync_orders_delta]: {e}")
+                return None
+
+            payment_map = get_payment_methods() or {}
+            affected_orders = {key: dict(changed_headers.get(key) or orders_map[key].to_dict()) for key in affected}
+            dati_aggiuntivi_map = prefetch_dati_aggiuntivi(o.get('cod_conto') for o in affected_orders.values())
+            # Indirizzi di spedizione dei soli clienti coinvolti in una ricerca (None: richieste singole)
+            shipping_address_map = get_shipping_address_map(
+                {o.get('cod_conto') for o in affected_orders.values() if o.get('cod_anag_sped')})
+
+            new_orders_map = {key: order for key, order in orders_map.items() if key not in deleted_keys}
+            existing_states = {state.order_key for state in PickingState.query.filter(PickingState.order_key.in_(list(affected))).all()} if affected else set()
+            for key, order in affected_orders.items():
+                rows = fetched_rows.get(key, []) if key in row_keys_to_fetch else orders_map[key].get('righe', [])
+                _enrich_order(order, new_client_map, payment_map, shipping_address_map, dati_aggiuntivi_map, rows)
+                new_orders_map[key] = OrderRecord.from_dict(order)
+                if key not in existing_states:
+                    db.session.add(PickingState(order_key=key, order_id=str(order.get('numero'))))
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"ERRORE [sync_orders_delta]: Salvataggio nuovi stati ordine fallito: {e}")
+                return None
+
+        sync_marks = {'last_sync_time': sync_started}
+        if check_deletions:
+            sync_marks['last_deletion_check'] = sync_started
+        if affected or deleted_keys:
+            _publish_snapshot(new_orders_map, new_client_map, sync_started,
+                              changed_keys=affected | deleted_keys, **sync_marks)
+            print(f"Sync delta ordini: {len(affected)} aggiornati, {len(deleted_keys)} rimossi, "
+                  f"{len(changed_clients)} clienti modificati.")
+        else:
+            _publish_snapshot(orders_map, client_map, sync_started, changed=False, **sync_marks) # Nessuna modifica: solo più recente
+        return affected | deleted_keys
 
-    search_data = { 'filtri': [{'campo': 'data_ult_mod', 'condizione': '>', 'valore': last_load_str}] }
+def refresh_order_snapshot(full=False):
+    """
+    Aggiorna lo snapshot ordini: sync delta se possibile, altrimenti (o con full=True)
+    load_all_data() completo. Restituisce (orders_map, client_map) correnti; in caso di
+    errore resta lo snapshot precedente (None, None se non ce n'è).
+    """
+    snapshot = _cache["snapshot"]
+    now = datetime.now()
+    if not full and snapshot is not None and _cache["last_full_load"] and now - _cache["last_full_load"] < ORDER_FULL_RELOAD_INTERVAL:
+        if sync_orders_delta() is not None:
+            snapshot = _cache["snapshot"]
+            return snapshot['orders_map'], snapshot['client_map']
+        print("Sync delta ordini non riuscita. Passo al ricaricamento completo.")
+
+    print("Ricarico tutti i dati ordini da Mexal...")
+    with _order_sync_lock:
+        orders_map, client_map = load_all_data() # Questa funzione ora popola il DB
+        if orders_map is not None:
+            sync_marks = {'last_sync_time': now, 'last_full_load': now, 'last_deletion_check': now}
+            previous = _cache["snapshot"]
+            if previous is None:
+                _publish_snapshot(orders_map, client_map, now, **sync_marks)
+            else:
+                # Confronto con lo snapshot precedente (record immutabili: '!=' costa poco):
+                # ai browser arrivano solo gli ordini davvero cambiati o spariti
+                old_map = previous['orders_map']
+                changed_keys = {key for key, record in orders_map.items() if old_map.get(key) != record}
+                changed_keys |= set(old_map) - set(orders_map)
+                if changed_keys:
+                    _publish_snapshot(orders_map, client_map, now, changed_keys=changed_keys, **sync_marks)
+                else:
+                    orders_map = old_map # Stessi dati: resta la generazione (e gli indici) corrente
+                    _publish_snapshot(orders_map, client_map, now, changed=False, **sync_marks)
+                print(f"Ricaricamento completo: {len(changed_keys)} ordini cambiati o rimossi.")
+            print("Cache ordini aggiornata.")
+            return orders_map, client_map
 
-    print(f"Polling: Verifico aggiornamenti da {last_load_str}...")
-    updates_testate = mx_call_api('risorse/documenti/ordini-clienti/ricerca', method='POST', data=search_data)
-    updates_righe = mx_call_api('risorse/documenti/ordini-clienti/righe/ricerca', method='POST', data=search_data)
+    print("Caricamento dati fallito. La cache non è stata aggiornata.")
+    snapshot = _cache["snapshot"]
+    return (snapshot['orders_map'], snapshot['client_map']) if snapshot else (None, None)
 
-    if updates_testate is None or updates_righe is None:
-         print("Polling: Errore durante la chiamata API.")
-         return jsonify({'new_data': False, 'error': 'API check failed'})
+def _order_refresher_loop():
+    """
+    Thread di background (solo nel processo refresher): aggiorna lo snapshot ogni
+    ORDER_REFRESH_INTERVAL, subito se svegliato o se un altro worker lo ha chiesto.
+    """
+    wakeup = _order_refresher["wakeup"]
+    _load_shared_snapshot() # Riparte dall'ultimo snapshot pubblicato (es. da un refresher precedente)
+    last_run = None
+    while True:
+        woken = wakeup.wait(ORDER_REFRESH_POLL_SECONDS)
+        wakeup.clear()
+        request_kind = _pop_shared_refresh_request()
+        due = _cache["snapshot"] is None or last_run is None or time.monotonic() - last_run >= ORDER_REFRESH_INTERVAL.total_seconds()
+        if not (woken or request_kind or due):
+            continue
+        if not is_mexal_available():
+            continue # Circuit breaker aperto: si riprova al prossimo giro
+        last_run = time.monotonic()
+        try:
+            with app.app_context():
+                if request_kind == 'full':
+                    _order_reload_flight.do('orders-full', refresh_order_snapshot, full=True)
+                else:
+                    _order_reload_flight.do('orders', refresh_order_snapshot)
+        except Exception as e:
+            print(f"ERRORE [order_refresher]: {e}")
 
-    if (isinstance(updates_testate.get('dati'), list) and updates_testate['dati']) or \
-       (isinstance(updates_righe.get('dati'), list) and updates_righe['dati']):
-        print("Polling: Rilevati aggiornamenti. Invalido cache ordini e articoli.")
-        _cache["orders_map"] = None # Invalida cache ordini
-        _cache["last_load_time"] = None
-        _article_details_cache.clear() # <-- SVUOTA CACHE ARTICOLI
+def _ensure_order_refresher():
+    """
+    Avvia il refresher se questo processo è (o diventa) quello designato, anche dopo un
+    fork di gunicorn. Restituisce True se il refresher gira in questo processo.
+    """
+    if not ORDER_REFRESHER_ENABLED or not _try_become_refresher_leader():
+        return False
+    thread = _order_refresher["thread"]
+    if thread is not None and thread.is_alive():
+        return True
+    with _order_refresher["lock"]:
+        thread = _order_refresher["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_order_refresher_loop, name='order-refresher', daemon=True)
+            thread.start()
+            _order_refresher["thread"] = thread
+            print("Refresher ordini in background avviato.")
+    return True
+
+def request_order_refresh(full=False):
+    """Chiede al refresher un aggiornamento immediato dello snapshot (senza aspettarlo)."""
+    if _is_refresher_leader():
+        _order_refresher["wakeup"].set()
+    else:
+        _request_shared_refresh(full=full)
+
+def get_cached_order_data():
+    """
+    Restituisce (orders_map, client_map) dallo snapshot corrente, senza aspettare Mexal:
+    l'aggiornamento avviene nel refresher in background e gli altri worker rileggono lo
+    snapshot condiviso. Solo nel processo refresher al primo avvio (nessuno snapshot) o con
+    il refresher disattivato la richiesta aggiorna i dati da sé; un altro worker senza
+    snapshot restituisce (None, None) e la pagina si aggiorna con l'evento SSE.
+    """
+    if ORDER_REFRESHER_ENABLED:
+        if not _ensure_order_refresher():
+            _load_shared_snapshot()
+            snapshot = _cache["snapshot"]
+            if snapshot:
+                return snapshot['orders_map'], snapshot['client_map']
+            print("Snapshot ordini non ancora pubblicato dal processo refresher.")
+            request_order_refresh()
+            _flash_if_request("Dati ordini in caricamento da Mexal: la pagina segnalerà quando sono pronti.", "info")
+            return None, None
+        snapshot = _cache["snapshot"]
+        if snapshot:
+            return snapshot['orders_map'], snapshot['client_map']
+        return _order_reload_flight.do('orders', refresh_order_snapshot)
+
+    snapshot = _cache["snapshot"]
+    if snapshot and _is_cache_valid(datetime.now()):
+        return snapshot['orders_map'], snapshot['client_map']
+
+    if snapshot and not is_mexal_available():
+        # Mexal non risponde (circuit breaker aperto): servi subito l'ultima copia buona
+        print("Mexal non raggiungibile. Uso i dati ordini in cache (scaduti).")
+        return snapshot['orders_map'], snapshot['client_map']
+
+    if snapshot and _order_reload_flight.in_flight('orders'):
+        # Ricaricamento già in corso in un'altra richiesta: non aspettarlo, usa i dati precedenti
+        print("Ricaricamento ordini già in corso. Uso i dati in cache (scaduti).")
+        return snapshot['orders_map'], snapshot['client_map']
+
+    return _order_reload_flight.do('orders', refresh_order_snapshot)
+
+@app.context_processor
+def inject_order_snapshot_age():
+    snapshot = _cache["snapshot"]
+    age = get_order_snapshot_age()
+    return {'orders_snapshot_age_minutes': int(age.total_seconds() // 60) if age is not None else None,
+            'orders_snapshot_generation': snapshot['generation'] if snapshot else 0,
+            'orders_snapshot_version': snapshot['version'] if snapshot else '',
+            'orders_live_page': request.endpoint in ORDER_LIVE_PAGES,
+            'orders_events_enabled': ORDER_EVENTS_ENABLED,
+            'orders_page_poll_seconds': ORDER_PAGE_POLL_SECONDS}
+
+@app.route('/admin/refresh-orders', methods=['POST'])
+@login_required
+def refresh_orders_admin():
+    """Aggiornamento completo forzato dello snapshot ordini (solo admin)."""
+    if not current_user.has_role('admin'):
+        flash("Accesso non autorizzato.", "danger")
+        return redirect(url_for('dashboard'))
+    if ORDER_REFRESHER_ENABLED and not _ensure_order_refresher():
+        # Il refresher gira in un altro worker: gli passa la richiesta
+        request_order_refresh(full=True)
+        flash("Ricaricamento ordini richiesto: i dati saranno aggiornati a breve.", "info")
+        return redirect(request.referrer or url_for('amministrazione'))
+    orders_map, _ = _order_reload_flight.do('orders-full', refresh_order_snapshot, full=True)
+    if orders_map is None:
+        flash("Errore durante il ricaricamento degli ordini da Mexal.", "danger")
+    else:
+        flash(f"Ordini ricaricati da Mexal ({len(orders_map)} ordini).", "success")
+    return redirect(request.referrer or url_for('amministrazione'))
+
+# --- Polling Route (applica alla cache le modifiche Mexal) ---
+@app.route('/check-updates')
+@login_required
+def check_updates():
+    """
+    Controlla se ci sono state modifiche su Mexal e le applica allo snapshot
+    (sync delta), senza buttare via gli ordini già caricati. Con ?generation=N
+    (generazione dello snapshot con cui la pagina è stata generata) segnala anche
+    le modifiche già applicate dal refresher in background.
+    """
+    refresher_here = not ORDER_REFRESHER_ENABLED or _ensure_order_refresher()
+    page_generation = request.args.get('generation', type=int)
+    changed_keys = set()
+    if not refresher_here:
+        # Il refresher gira in un altro worker: gli chiede una sync e risponde subito con lo
+        # snapshot corrente; l'esito arriva alla pagina con l'evento SSE 'ordini'
+        _load_shared_snapshot()
+        request_order_refresh()
+        if _cache["snapshot"] is None:
+            return jsonify({'new_data': False, 'refresh_requested': True})
+    elif not _cache.get("last_sync_time"):
+        print("Polling: Dati mai caricati, forzo aggiornamento.")
         return jsonify({'new_data': True})
+    elif _order_reload_flight.in_flight('orders') or _order_reload_flight.in_flight('orders-full'):
+        # Non si attende _order_sync_lock dietro un caricamento: si risponde con lo snapshot corrente
+        print("Polling: Aggiornamento ordini già in corso.")
+    else:
+        print(f"Polling: Verifico aggiornamenti da {_cache['last_sync_time'].strftime('%Y%m%d %H%M%S')}...")
+        changed_keys = _order_reload_flight.do('orders-delta', sync_orders_delta)
+        if changed_keys is None:
+            print("Polling: Errore durante la chiamata API.")
+            return jsonify({'new_data': False, 'error': 'API check failed'})
+
+    snapshot = _cache["snapshot"]
+    status = {'generation': snapshot['generation'], 'version': snapshot['version'],
+              'snapshot_age_seconds': int(get_order_snapshot_age().total_seconds()),
+              'refresh_requested': not refresher_here}
+    if changed_keys or (page_generation is not None and page_generation != snapshot['generation']):
+        print(f"Polling: Dati aggiornati ({len(changed_keys)} ordini in questa verifica).")
+        return jsonify({'new_data': True, 'orders': sorted(changed_keys), **status})
     else:
         print(f"Polling: Nessun aggiornamento rilevato.")
-        return jsonify({'new_data': False})
+        return jsonify({'new_data': False, **status})
+
+# --- Notifiche ordini ai browser (Server-Sent Events) ---
+# Le modifiche su Mexal le rileva solo il refresher (una ricerca delta per intervallo);
+# ogni connessione SSE legge lo snapshot locale, quindi le chiamate a Mexal non
+# dipendono dal numero di browser aperti. Ogni connessione occupa un thread:
+# con gunicorn serve un worker a thread (gthread) o asincrono, quindi va attivato
+# esplicitamente (ORDER_EVENTS_ENABLED=1). Altrimenti le pagine in ORDER_LIVE_PAGES
+# interrogano ogni ORDER_PAGE_POLL_SECONDS l'API delle modifiche (solo snapshot locale).
+ORDER_EVENTS_ENABLED = os.getenv('ORDER_EVENTS_ENABLED', '0') == '1'
+ORDER_PAGE_POLL_SECONDS = int(os.getenv('ORDER_PAGE_POLL_SECONDS', '60'))
+ORDER_LIVE_PAGES = ('ordini_list', 'trasporto') # Le sole pagine che aggiornano le righe ordini
+ORDER_EVENTS_POLL_SECONDS = 2       # Ogni quanto la connessione controlla lo snapshot locale
+ORDER_EVENTS_KEEPALIVE_SECONDS = 20 # Commento SSE per non far chiudere la connessione ai proxy
+ORDER_EVENTS_MAX_SECONDS = int(os.getenv('ORDER_EVENTS_MAX_SECONDS', '300')) # Poi il browser si riconnette da sé
+
+def _order_event_payload(snapshot, since_version):
+    """
+    Dati dell'evento 'ordini' per un browser fermo a since_version. 'orders' è None
+    se le chiavi cambiate non sono ricostruibili (vedi get_order_changes_since).
+    """
+    orders = get_order_changes_since(snapshot, since_version)
+    return {'version': snapshot['version'], 'generation': snapshot['generation'],
+            'orders': sorted(orders) if orders is not None else None,
+            'loaded_at': snapshot['loaded_at'].isoformat(timespec='seconds')}
+
+@app.route('/eventi/ordini')
+@login_required
+def order_events():
+    """
+    Stream SSE: un evento 'ordini' (id = versione) ogni volta che lo snapshot cambia.
+    Il browser indica la versione della pagina con ?version=...; alla riconnessione
+    EventSource invia da sé Last-Event-ID.
+    """
+    if not ORDER_EVENTS_ENABLED:
+        return Response(status=204) # 204: EventSource smette di riconnettersi
+    if not (current_user.has_role('admin') or current_user.has_role('preparatore')):
+        return jsonify({'error': 'Accesso non autorizzato.'}), 403
+    if ORDER_REFRESHER_ENABLED:
+        _ensure_order_refresher() # Il rilevatore deve girare anche se nessuno apre pagine ordini
+    since_version = request.headers.get('Last-Event-ID') or request.args.get('version')
+    follower = ORDER_REFRESHER_ENABLED and not _is_refresher_leader()
+
+    def stream(since_version):
+        yield f"retry: {ORDER_EVENTS_POLL_SECONDS * 1000}\n\n"
+        started = last_write = time.monotonic()
+        while time.monotonic() - started < ORDER_EVENTS_MAX_SECONDS:
+            if follower:
+                _load_shared_snapshot() # Solo una stat del file se non è cambiato
+            snapshot = _cache["snapshot"]
+            if snapshot and snapshot['version'] != since_version:
+                payload = _order_event_payload(snapshot, since_version)
+                since_version = snapshot['version']
+                yield f"id: {since_version}\nevent: ordini\ndata: {json.dumps(payload)}\n\n"
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= ORDER_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_write = time.monotonic()
+            time.sleep(ORDER_EVENTS_POLL_SECONDS)
+
+    return Response(stream(since_version), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 # --- Rotte Principali (Rifattorizzate per DB) ---
 
+def _data_formattata(date_str):
+    """'AAAAMMGG' -> 'GG/MM/AAAA' (intestazione dei gruppi per data nelle liste ordini)."""
+    if isinstance(date_str, str) and len(date_str) == 8:
+        return f"{date_str[6:8]}/{date_str[4:6]}/{date_str[0:4]}"
+    return "Data Sconosciuta"
+
+def _ordini_row_view(record, state):
+    """Vista di un ordine per la lista /ordini (stato locale dal PickingState)."""
+    # Vista per questa richiesta: i campi calcolati non finiscono nello snapshot condiviso
+    return OrderView(record, local_status=state.status if state else 'Da Lavorare',
+                     data_formattata=_data_formattata(record.get('data_documento')))
+
+def _trasporto_row_view(record, assignment):
+    """Vista di un ordine per /trasporto (vettore e nota dall'assegnazione salvata)."""
+    vettore_info = {'codice': assignment.autista_codice, 'nome': assignment.autista_nome} if assignment else None
+    return OrderView(record, vettore_assegnato_info=vettore_info,
+                     nota_autista=(assignment.nota_autista or '') if assignment else '',
+                     data_formattata=_data_formattata(record.get('data_documento')))
+
 @app.route('/')
 @login_required
 def dashboard():
@@ -576,33 +1450,25 @@ def ordini_list():
         return render_template('orders.html', ordini_per_data=OrderedDict(), giorno_selezionato=None, active_page='ordini', enable_polling=False)
 
     giorno_filtro = request.args.get('giorno_filtro')
-    filtered_orders_keys = []
+    indexes = get_order_indexes(orders_map)
 
-    # Filtra le CHIAVI degli ordini
+    # Filtra le CHIAVI degli ordini (indici già ordinati per data documento)
     if giorno_filtro:
         try:
             giorno_da_cercare = giorno_filtro.strip().zfill(2)
             if not giorno_da_cercare.isdigit() or len(giorno_da_cercare) != 2:
                 raise ValueError("Formato giorno non valido.")
             
-            for key, order in orders_map.items():
-                if isinstance(order.get('data_documento'), str) and len(order['data_documento']) == 8 and order['data_documento'].endswith(giorno_da_cercare):
-                    filtered_orders_keys.append(key)
+            filtered_orders_keys = list(indexes['by_day'].get(giorno_da_cercare, ()))
             
             if not filtered_orders_keys:
                  flash(f"Nessun ordine trovato per il giorno '{giorno_filtro}'.", "info")
 
         except ValueError as e:
             flash(f"Filtro giorno non valido: {e}. Mostro tutti gli ordini.", "warning")
-            filtered_orders_keys = list(orders_map.keys())
+            filtered_orders_keys = list(indexes['sorted_keys'])
     else:
-        filtered_orders_keys = list(orders_map.keys())
-
-    # Ordina le CHIAVI per data documento
-    filtered_orders_keys.sort(
-        key=lambda key: orders_map.get(key, {}).get('data_documento', '0'), 
-        reverse=True
-    )
+        filtered_orders_keys = list(indexes['sorted_keys'])
 
     # Recupera gli stati solo per gli ordini filtrati
     ordini_per_data = OrderedDict()
@@ -616,20 +1482,8 @@ def ordini_list():
         states_map = {}
         
     for key in filtered_orders_keys:
-        order = orders_map[key]
-        state = states_map.get(key)
-
-        order['local_status'] = state.status if state else 'Da Lavorare'
-        
-        date_str = order.get('data_documento')
-        data_formattata = "Data Sconosciuta"
-        if isinstance(date_str, str) and len(date_str) == 8:
-             try:
-                data_formattata = f"{date_str[6:8]}/{date_str[4:6]}/{date_str[0:4]}"
-             except IndexError: pass
-        order['data_formattata'] = data_formattata
-
-        ordini_per_data.setdefault(data_formattata, []).append(order)
+        order = _ordini_row_view(orders_map[key], states_map.get(key))
+        ordini_per_data.setdefault(order['data_formattata'], []).append(order)
 
     return render_template('orders.html', ordini_per_data=ordini_per_data, giorno_selezionato=giorno_filtro, active_page='ordini', enable_polling=True)
 
@@ -652,41 +1506,87 @@ def trasporto():
         vettori = []
 
     ordini_per_data = OrderedDict()
-    # Ordina le CHIAVI
-    sorted_keys = sorted(
-        orders_map.keys(), 
-        key=lambda key: orders_map.get(key, {}).get('data_documento', '0'), 
-        reverse=True
-    )
+    # CHIAVI già ordinate per data documento nell'indice dello snapshot
+    sorted_keys = get_order_indexes(orders_map)['sorted_keys']
 
     # Recupera tutte le assegnazioni in una sola query
     assignments_db = LogisticsAssignment.query.all()
     assignments_map = {a.order_key: a for a in assignments_db}
 
     for key in sorted_keys:
-        order = orders_map[key]
-        assignment = assignments_map.get(key)
-        
-        if assignment:
-            order['vettore_assegnato_info'] = {
-                'codice': assignment.autista_codice,
-                'nome': assignment.autista_nome
-            }
-            order['nota_autista'] = assignment.nota_autista or ''
-        else:
-            order['vettore_assegnato_info'] = None
-            order['nota_autista'] = ''
+        order = _trasporto_row_view(orders_map[key], assignments_map.get(key))
+        ordini_per_data.setdefault(order['data_formattata'], []).append(order)
 
-        date_str = order.get('data_documento')
-        data_formattata = "Data Sconosciuta"
-        if isinstance(date_str, str) and len(date_str) == 8:
-             try: data_formattata = f"{date_str[6:8]}/{date_str[4:6]}/{date_str[0:4]}"
-             except IndexError: pass
-        order['data_formattata'] = data_formattata
+    return render_template('trasporto.html', ordini_per_data=ordini_per_data, vettori=vettori, active_page='trasporto', enable_polling=True)
 
-        ordini_per_data.setdefault(data_formattata, []).append(order)
 
-    return render_template('trasporto.html', ordini_per_data=ordini_per_data, vettori=vettori, active_page='trasporto', enable_polling=True)
+# --- Modifiche ordini per versione (aggiornamento righe senza ricaricare la pagina) ---
+def _with_order_etag(response, version):
+    """ETag = versione dello snapshot; il browser rivalida sempre (If-None-Match)."""
+    response.set_etag(version)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/ordini/modifiche')
+@login_required
+def order_changes_api():
+    """
+    Ordini cambiati dopo la versione ?since= dello snapshot, con il frammento HTML della
+    riga per la pagina indicata da ?vista= ('ordini', con l'eventuale ?giorno=, o 'trasporto').
+    'removed' elenca le chiavi da togliere dalla pagina; 'full' indica che le modifiche non
+    sono ricostruibili e la pagina va ricaricata. ETag = versione corrente: con
+    If-None-Match uguale risponde 304 senza calcolare nulla.
+    """
+    vista = request.args.get('vista', 'ordini')
+    if vista == 'trasporto':
+        allowed = current_user.has_role('admin')
+    elif vista == 'ordini':
+        allowed = current_user.has_role('admin') or current_user.has_role('preparatore')
+    else:
+        return jsonify({'error': f"Vista '{vista}' non valida."}), 400
+    if not allowed:
+        return jsonify({'error': 'Accesso non autorizzato.'}), 403
+
+    # Prima il confronto con l'ETag (al più una stat del file condiviso): niente sync né caricamenti
+    if ORDER_REFRESHER_ENABLED and not _is_refresher_leader():
+        _load_shared_snapshot()
+    snapshot = _cache["snapshot"]
+    if snapshot and request.if_none_match.contains(snapshot['version']):
+        return _with_order_etag(Response(status=304), snapshot['version'])
+
+    orders_map, _ = get_cached_order_data()
+    snapshot = _cache["snapshot"]
+    if orders_map is None or snapshot is None:
+        return jsonify({'error': 'Dati ordini non disponibili.'}), 503
+    changed_keys = get_order_changes_since(snapshot, request.args.get('since'))
+    payload = {'version': snapshot['version'], 'full': changed_keys is None, 'orders': [], 'removed': []}
+    # Stesso filtro giorno di /ordini (un filtro non valido là mostra tutti gli ordini)
+    giorno = (request.args.get('giorno') or '').strip() if vista == 'ordini' else ''
+    giorno = giorno.zfill(2) if giorno.isdigit() and len(giorno) <= 2 else ''
+    visible_keys = []
+    for key in sorted(changed_keys or ()):
+        record = orders_map.get(key)
+        if record is None or (giorno and str(record.get('data_documento', ''))[6:8] != giorno):
+            payload['removed'].append(key)
+        else:
+            visible_keys.append(key)
+
+    if visible_keys:
+        if vista == 'ordini':
+            states_map = {state.order_key: state for state in
+                          PickingState.query.filter(PickingState.order_key.in_(visible_keys)).all()}
+            views = [_ordini_row_view(orders_map[key], states_map.get(key)) for key in visible_keys]
+            render = lambda order: render_template('orders_row.html', order=order)
+        else:
+            assignments_map = {a.order_key: a for a in
+                               LogisticsAssignment.query.filter(LogisticsAssignment.order_key.in_(visible_keys)).all()}
+            views = [_trasporto_row_view(orders_map[key], assignments_map.get(key)) for key in visible_keys]
+            vettori = get_vettori() or []
+            render = lambda order: render_template('trasporto_row.html', order=order, vettori=vettori)
+        payload['orders'] = [{'key': key, 'data_formattata': order['data_formattata'], 'html': render(order)}
+                             for key, order in zip(visible_keys, views)]
+    response = jsonify(payload)
+    return _with_order_etag(response, snapshot['version'])
 
 
 # --- Salvataggio Assegnazioni (Rifattorizzato per DB) ---
@@ -810,13 +1710,13 @@ def calcola_giri():
     giri_per_vettore = defaultdict(list)
     print("DEBUG [calcola_giri]: Raggruppamento ordini per vettore...")
     for assign in assignments:
-        ordine_completo = orders_map.get(assign.order_key)
+        ordine_completo = orders_map.get(assign.order_key) or get_order_record(assign.order_key)
         if ordine_completo:
-            ordine_completo['_order_key'] = assign.order_key
+            ordine_completo = OrderView(ordine_completo, _order_key=assign.order_key)
             giri_per_vettore[assign.autista_nome].append(ordine_completo)
             print(f"  + Ordine {assign.order_key} assegnato a {assign.autista_nome}. Indirizzo: '{ordine_completo.get('indirizzo_effettivo')}'")
         else:
-            print(f"WARN [calcola_giri]: Ordine {assign.order_key} non trovato nella cache.")
+            print(f"WARN [calcola_giri]: Ordine {assign.order_key} non trovato né in cache né su Mexal.")
 
     # 4. Inizializza Google Maps Client
     google_api_key = os.getenv('GOOGLE_MAPS_API_KEY')
@@ -909,7 +1809,7 @@ def calcola_giri():
                 'tempo_soste_stimato': time.strftime("%Hh %Mm", time.gmtime(tempo_soste_sec)),
                 'tempo_totale_stimato': time.strftime("%Hh %Mm", time.gmtime(durata_totale_stimata_sec)),
                 'rientro_previsto': rientro_previsto.strftime('%H:%M'),
-                'tappe': tappe_ordinate_oggetti, # Questa è una lista di dizionari
+                'tappe': [tappa.to_dict() for tappa in tappe_ordinate_oggetti], # Lista di dizionari (serializzabile)
             }
             
             calculated_routes_to_save.append({
@@ -1027,10 +1927,9 @@ def consegne_autista(autista_nome):
             orders_map, _ = get_cached_order_data()
             if orders_map:
                 for key in order_keys_assegnati:
-                    ordine_completo = orders_map.get(key)
+                    ordine_completo = orders_map.get(key) or get_order_record(key) # Fuori finestra: su richiesta
                     if ordine_completo:
-                        ordine_completo['_order_key'] = key
-                        tappe_da_mostrare.append(ordine_completo)
+                        tappe_da_mostrare.append(OrderView(ordine_completo, _order_key=key))
                 print(f"  + Aggiunti {len(tappe_da_mostrare)} ordini (senza giro)")
                 tappe_da_mostrare.sort(key=lambda x: x.get('numero', 0))
         
@@ -1222,11 +2121,9 @@ def end_consegna():
             db.session.commit()
             
             # Recupera nome cliente per notifica (dalla cache ordini)
-            orders_map, _ = get_cached_order_data()
-            if orders_map:
-                ordine = orders_map.get(order_key)
-                if ordine:
-                    nome_cliente_notifica = ordine.get('ragione_sociale', 'Cliente Sconosciuto')
+            ordine = get_order_record(order_key)
+            if ordine:
+                nome_cliente_notifica = ordine.get('ragione_sociale', 'Cliente Sconosciuto')
             
             flash(f"Consegna per {nome_cliente_notifica} ({order_key}) completata alle {timestamp_fine}.", "success")
             send_notification_flag = True
@@ -1439,19 +2336,13 @@ def order_detail_view(sigla, serie, numero):
     order_key = f"{sigla}:{serie}:{numero}"
     order_id = str(numero) # order_id è solo il numero
 
-    # 1. Recupera i dati dell'ordine (immutabili) dalla cache
-    orders_map, _ = get_cached_order_data()
-    if orders_map is None:
-        flash("Errore nel caricamento dei dati ordine, riprova.", "danger")
-        return redirect(url_for('ordini_list'))
-        
-    order_data = orders_map.get(order_key)
+    # 1. Recupera i dati dell'ordine (immutabili) dalla cache, o da Mexal se fuori finestra
+    order_data = get_order_record(order_key)
 
     if not order_data:
         flash(f"Errore: Impossibile trovare l'ordine {order_key}.", "danger")
-        # Invalida la cache e ricarica
-        _cache["orders_map"] = None
-        _cache["last_load_time"] = None
+        # L'ordine potrebbe essere nuovo: chiede subito una sync delta al refresher
+        request_order_refresh()
         return redirect(url_for('ordini_list'))
     
     # 2. Recupera lo stato (mutabile) dal DB
@@ -1496,8 +2387,10 @@ def order_detail_view(sigla, serie, numero):
         'picked_items': picked_items
     }
 
+    # Righe come dict: il template le serializza in JSON per il picking
+    order_view = OrderView(order_data, righe=[row._asdict() for row in order_data.righe])
     return render_template('order_detail.html',
-                           order=order_data, # Dati ordine (righe, cliente...)
+                           order=order_view, # Dati ordine (righe, cliente...)
                            state=order_state_dict) # Stato picking (status, packing_list...)
 
 
@@ -1518,8 +2411,7 @@ def _add_item_to_collo_helper(sigla, serie, numero, collo_id, primary_code):
             return jsonify({'status': 'error', 'message': 'Stato ordine non trovato nel DB'}), 404
         
         # 2. Recupera i dati dell'ordine dalla cache
-        orders_map, _ = get_cached_order_data()
-        order_data = orders_map.get(order_key)
+        order_data = get_order_record(order_key)
         if not order_data:
             return jsonify({'status': 'error', 'message': 'Dati ordine non trovati in cache'}), 404
 
@@ -1611,6 +2503,32 @@ def _add_item_to_collo_helper(sigla, serie, numero, collo_id, primary_code):
         import traceback; traceback.print_exc()
         return jsonify({'status': 'error', 'message': f"Errore server: {e}"}), 500
 
+# --- Risoluzione barcode dal catalogo locale (evita chiamate Mexal ad ogni scansione) ---
+def resolve_barcode(barcode):
+    """
+    Risolve un barcode nel codice articolo: prima il catalogo articoli locale (nessuna
+    chiamata di rete), poi Mexal come fallback. Restituisce il codice articolo o None.
+    """
+    _schedule_catalog_sync()
+
+    if is_article_catalog_ready():
+        # In caso di codici alternativi duplicati vince il primo (come la ricerca Mexal)
+        entry = ArticleCatalog.query.filter_by(cod_alternativo=barcode).order_by(ArticleCatalog.codice).first()
+        if entry:
+            return entry.codice
+        if ArticleCatalog.query.get(barcode):
+            return barcode # Il barcode è già un codice articolo noto
+
+    primary_code = find_article_code_by_alt_code(barcode)
+    if primary_code:
+        _catalog_update_alt_code(primary_code, barcode)
+        return primary_code
+
+    temp_details = get_article_details(barcode)
+    if temp_details and temp_details.get('codice') == barcode:
+        return barcode
+    return None
+
 # Le tre funzioni API (scan, add, remove) chiamano l'helper, quindi non serve modificarle
 @app.route('/api/scan-barcode/<sigla>/<int:serie>/<int:numero>/collo/<int:collo_id>', methods=['POST'])
 @login_required
@@ -1622,13 +2540,9 @@ def scan_barcode_for_collo(sigla, serie, numero, collo_id):
     if not barcode:
         return jsonify({'status': 'error', 'message': 'Barcode mancante'}), 400
     
-    primary_code = find_article_code_by_alt_code(barcode)
+    primary_code = resolve_barcode(barcode)
     if not primary_code:
-        temp_details = get_article_details(barcode)
-        if temp_details and temp_details.get('codice') == barcode:
-             primary_code = barcode
-        else:
-             return jsonify({'status': 'not_found', 'message': f"Articolo non trovato per barcode '{barcode}'."}), 404
+        return jsonify({'status': 'not_found', 'message': f"Articolo non trovato per barcode '{barcode}'."}), 404
     
     return _add_item_to_collo_helper(sigla, serie, numero, collo_id, primary_code)
 
@@ -1706,8 +2620,7 @@ def remove_item_from_collo(sigla, serie, numero, collo_id):
         if not state:
             return jsonify({'status': 'error', 'message': 'Stato ordine non trovato'}), 404
             
-        orders_map, _ = get_cached_order_data()
-        order_data = orders_map.get(order_key, {})
+        order_data = get_order_record(order_key) or {}
 
         packing_list = json.loads(state.packing_list_json or '[]')
         picked_items = json.loads(state.picked_items_json or '{}')
@@ -1833,8 +2746,7 @@ def order_action(sigla, serie, numero):
         stato_precedente = state.status
         
         # Recupera i dati ordine (per nome cliente e righe) dalla cache
-        orders_map, _ = get_cached_order_data()
-        order_info = orders_map.get(order_key, {})
+        order_info = get_order_record(order_key) or {}
         if order_info:
             order_name_notifica = f"#{order_id} ({order_info.get('ragione_sociale', 'N/D')})"
 
@@ -2088,6 +3000,276 @@ def order_action(sigla, serie, numero):
     return redirect(url_for('order_detail_view', sigla=sigla, serie=serie, numero=numero))
 
 # --- Rotte Magazzino, Clienti, Todo (Invariate) ---
+# --- Catalogo articoli locale (FTS5) per la ricerca magazzino ---
+CATALOG_SYNC_INTERVAL = timedelta(minutes=int(os.getenv('CATALOG_SYNC_MINUTES', '10')))
+# data_ult_mod non cambia con i movimenti di magazzino: le giacenze si riallineano con la ricostruzione completa
+CATALOG_FULL_SYNC_INTERVAL = timedelta(hours=int(os.getenv('CATALOG_FULL_SYNC_HOURS', '6')))
+CATALOG_SEARCH_LIMIT = int(os.getenv('CATALOG_SEARCH_LIMIT', '50'))
+_catalog_sync_flight = SingleFlight()
+# Con più worker gunicorn la sync la esegue un solo processo alla volta (stesso file SQLite)
+CATALOG_SYNC_LOCK_PATH = os.path.join(app.instance_path, 'catalog_sync.lock')
+_catalog_fts_available = True
+
+def _ensure_article_catalog_fts():
+    """Crea (se mancano) gli indici del catalogo. Senza FTS5 la ricerca ripiega su LIKE."""
+    global _catalog_fts_available
+    try:
+        # Indice per la risoluzione barcode anche su tabelle create prima della colonna indicizzata
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_article_catalog_cod_alternativo ON article_catalog (cod_alternativo)"))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRORE [_ensure_article_catalog_fts]: {e}")
+    try:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS article_catalog_fts USING fts5("
+            "codice, descrizione, descr_completa, cod_alternativo, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _catalog_fts_available = False
+        print(f"WARN: Indice FTS5 catalogo non disponibile, uso ricerca LIKE: {e}")
+
+def _to_float(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+def _catalog_row(article):
+    return {
+        'codice': article['codice'],
+        'descrizione': article.get('descrizione') or '',
+        'descr_completa': article.get('descr_completa') or '',
+        'cod_alternativo': (article.get('cod_alternativo') or '').strip(),
+        'cod_grp_merc': article.get('cod_grp_merc') or '',
+        'qta_carico': _to_float(article.get('qta_carico')),
+        'qta_scarico': _to_float(article.get('qta_scarico')),
+        'ord_cli_e': _to_float(article.get('ord_cli_e')),
+        'ord_cli_sps': _to_float(article.get('ord_cli_sps')),
+    }
+
+def _fts_replace(rows, codes_to_remove=None):
+    """Riallinea le voci FTS: rimuove i codici indicati (tutti se None) e inserisce le righe date."""
+    if not _catalog_fts_available:
+        return
+    if codes_to_remove is None:
+        db.session.execute(text("DELETE FROM article_catalog_fts"))
+    else:
+        for codice in codes_to_remove:
+            db.session.execute(text("DELETE FROM article_catalog_fts WHERE codice = :codice"), {'codice': codice})
+    if rows:
+        db.session.execute(
+            text("INSERT INTO article_catalog_fts (codice, descrizione, descr_completa, cod_alternativo) "
+                 "VALUES (:codice, :descrizione, :descr_completa, :cod_alternativo)"),
+            [{k: r[k] for k in ('codice', 'descrizione', 'descr_completa', 'cod_alternativo')} for r in rows]
+        )
+
+def sync_article_catalog(full=False):
+    """
+    Allinea ArticleCatalog (e il suo indice FTS5) con Mexal. Ricostruisce tutto alla prima
+    esecuzione, con full=True o quando l'ultima ricostruzione è più vecchia di
+    CATALOG_FULL_SYNC_INTERVAL; altrimenti scarica solo gli articoli con data_ult_mod recente.
+    Restituisce il numero di articoli elaborati, o None in caso di errore.
+    """
+    state = SyncState.query.get('article_catalog')
+    full_state = SyncState.query.get('article_catalog_full')
+    sync_started = datetime.now()
+    if not state or not full_state or sync_started - full_state.last_sync >= CATALOG_FULL_SYNC_INTERVAL:
+        full = True
+    filtri = []
+    if not full:
+        filtri = [{'campo': 'data_ult_mod', 'condizione': '>', 'valore': state.last_sync.strftime('%Y%m%d %H%M%S')}]
+
+    try:
+        rows = [
+            _catalog_row(a) for a in mx_iter_search('risorse/articoli/ricerca', filtri=filtri, fields=ARTICLE_CATALOG_FIELDS)
+            if a.get('codice')
+        ]
+    except MexalAPIError as e:
+        print(f"ERRORE [sync_article_catalog]: {e}")
+        return None
+
+    try:
+        if full:
+            ArticleCatalog.query.delete()
+            _fts_replace(rows)
+        else:
+            changed_codes = [r['codice'] for r in rows]
+            if changed_codes:
+                ArticleCatalog.query.filter(ArticleCatalog.codice.in_(changed_codes)).delete(synchronize_session=False)
+            _fts_replace(rows, codes_to_remove=changed_codes)
+        db.session.bulk_insert_mappings(ArticleCatalog, rows)
+
+        for name in (['article_catalog', 'article_catalog_full'] if full else ['article_catalog']):
+            entry = SyncState.query.get(name)
+            if entry:
+                entry.last_sync = sync_started
+            else:
+                db.session.add(SyncState(name=name, last_sync=sync_started))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRORE [sync_article_catalog]: Salvataggio catalogo fallito: {e}")
+        return None
+
+    # Le cache articolo in memoria perdono solo le voci degli articoli cambiati
+    if full:
+        _article_group_cache.invalidate()
+        invalidate_article_details()
+    else:
+        for row in rows:
+            _article_group_cache.invalidate(row['codice'])
+            invalidate_article_details(row['codice'])
+
+    print(f"Catalogo articoli {'ricostruito' if full else 'aggiornato (delta)'}: {len(rows)} articoli.")
+    return len(rows)
+
+def _schedule_catalog_sync():
+    """Avvia in background una sync del catalogo se l'ultima è più vecchia di CATALOG_SYNC_INTERVAL."""
+    state = SyncState.query.get('article_catalog')
+    if state and datetime.now() - state.last_sync < CATALOG_SYNC_INTERVAL:
+        return
+    if _catalog_sync_flight.in_flight('catalog'):
+        return
+
+    def run():
+        with app.app_context():
+            _catalog_sync_flight.do('catalog', _sync_article_catalog_locked)
+
+    threading.Thread(target=run, name='catalog-sync', daemon=True).start()
+
+def _sync_article_catalog_locked():
+    """sync_article_catalog() con lock su file tra processi; salta se un altro processo la sta già eseguendo."""
+    try:
+        lock_file = open(CATALOG_SYNC_LOCK_PATH, 'a')
+    except OSError as e:
+        print(f"ERRORE [_sync_article_catalog_locked]: {e}")
+        return None
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+        # Un altro processo potrebbe averla appena completata
+        state = SyncState.query.get('article_catalog')
+        if state and datetime.now() - state.last_sync < CATALOG_SYNC_INTERVAL:
+            return None
+        return sync_article_catalog()
+    finally:
+        lock_file.close() # Rilascia anche il lock
+
+def is_article_catalog_ready():
+    return SyncState.query.get('article_catalog_full') is not None
+
+def _fts_match_expression(query):
+    """'vite m6 inox' -> '"vite"* "m6"* "inox"*' (tutti i token, ciascuno come prefisso)."""
+    tokens = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+def search_article_catalog(query, limit=None):
+    """
+    Cerca nel catalogo locale per codice, descrizione o codice alternativo. Ogni parola
+    della query deve comparire (anche come prefisso); il codice esatto viene per primo.
+    Restituisce una lista di dict con gli stessi campi della ricerca Mexal.
+    """
+    limit = max(1, min(limit or CATALOG_SEARCH_LIMIT, CATALOG_SEARCH_LIMIT))
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    if _catalog_fts_available:
+        match = _fts_match_expression(query)
+        if not match:
+            return []
+        try:
+            found = db.session.execute(text(
+                "SELECT f.codice FROM article_catalog_fts f "
+                "WHERE article_catalog_fts MATCH :match "
+                "ORDER BY (f.codice = :q) DESC, (f.cod_alternativo = :q) DESC, f.rank "
+                "LIMIT :limit"
+            ), {'match': match, 'q': query, 'limit': limit}).fetchall()
+        except Exception as e:
+            print(f"ERRORE [search_article_catalog]: Query FTS '{match}' fallita: {e}")
+            return []
+        codes = [row[0] for row in found]
+        articles = {a.codice: a for a in ArticleCatalog.query.filter(ArticleCatalog.codice.in_(codes)).all()} if codes else {}
+        return [articles[c].to_dict() for c in codes if c in articles]
+
+    conditions = []
+    for token in query.split():
+        pattern = f"%{token}%"
+        conditions.append(db.or_(ArticleCatalog.codice.ilike(pattern),
+                                 ArticleCatalog.descrizione.ilike(pattern),
+                                 ArticleCatalog.descr_completa.ilike(pattern),
+                                 ArticleCatalog.cod_alternativo.ilike(pattern)))
+    results = ArticleCatalog.query.filter(*conditions).order_by(ArticleCatalog.codice).limit(limit).all()
+    results.sort(key=lambda a: (a.codice != query, a.cod_alternativo != query))
+    return [a.to_dict() for a in results]
+
+def _catalog_update_alt_code(article_code, alt_code):
+    """Aggiorna il codice alternativo nel catalogo locale dopo una modifica riuscita su Mexal."""
+    try:
+        article = ArticleCatalog.query.get(article_code)
+        if not article:
+            return
+        article.cod_alternativo = (alt_code or '').strip()
+        _fts_replace([_catalog_row(article.to_dict())], codes_to_remove=[article_code])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRORE [_catalog_update_alt_code]: {e}")
+
+@app.route('/api/articoli/suggerimenti')
+@login_required
+def article_suggestions_api():
+    """Typeahead magazzino: risponde dal catalogo locale, senza chiamate Mexal."""
+    if not (current_user.has_role('admin') or current_user.has_role('preparatore')):
+        return jsonify({'status': 'error', 'message': 'Accesso non autorizzato'}), 403
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 10, type=int) or 10, CATALOG_SEARCH_LIMIT)) # LIMIT -1 in SQLite = nessun limite
+    _schedule_catalog_sync()
+    if len(query) < 2 or not is_article_catalog_ready():
+        return jsonify({'status': 'ok', 'catalog_ready': is_article_catalog_ready(), 'articoli': []})
+
+    suggestions = []
+    for art in search_article_catalog(query, limit=limit):
+        suggestions.append({
+            'codice': art['codice'],
+            'descrizione': art['descr_completa'] or art['descrizione'],
+            'cod_alternativo': art['cod_alternativo'],
+            'giacenza_netta': art['qta_carico'] - art['qta_scarico'] - art['ord_cli_e'] - art['ord_cli_sps'],
+        })
+    return jsonify({'status': 'ok', 'catalog_ready': True, 'articoli': suggestions})
+
+@app.route('/api/articoli/<path:codice>/ordini')
+@login_required
+def article_orders_api(codice):
+    """Ordini in cache che contengono un articolo (indice codice_articolo -> righe)."""
+    if not (current_user.has_role('admin') or current_user.has_role('preparatore')):
+        return jsonify({'status': 'error', 'message': 'Accesso non autorizzato'}), 403
+    orders_map, _ = get_cached_order_data()
+    if orders_map is None:
+        return jsonify({'status': 'error', 'message': 'Dati ordini non disponibili'}), 503
+
+    risultati = []
+    for order_key, id_riga in get_order_indexes(orders_map)['by_article'].get(codice, ()):
+        order = orders_map.get(order_key)
+        row = next((r for r in order.righe if r.get('id_riga') == id_riga), None) if order else None
+        if row:
+            risultati.append({
+                'order_key': order_key,
+                'numero': order.get('numero'),
+                'data_documento': order.get('data_documento'),
+                'ragione_sociale': order.get('ragione_sociale'),
+                'nr_colli': row.get('nr_colli'),
+                'quantita': row.get('quantita'),
+            })
+    return jsonify({'status': 'ok', 'codice': codice, 'ordini': risultati})
+
 # ... (incolla qui le tue funzioni magazzino, update_alt_code_api, clienti_indirizzi, e tutte le rotte todo_...) ...
 # (Assicurati di incollare: magazzino, update_alt_code_api, clienti_indirizzi, todo_list, add_todo, toggle_todo, delete_todo)
 @app.route('/magazzino')
@@ -2107,7 +3289,22 @@ def magazzino():
         is_likely_code = ' ' not in query
         articles_data = None
         
-        if is_likely_code:
+        _schedule_catalog_sync()
+        if is_article_catalog_ready():
+            # Catalogo locale solo per trovare i codici: i progressivi locali si riallineano
+            # solo col rebuild completo, la giacenza si rilegge da Mexal in una sola ricerca
+            articles_data = search_article_catalog(query) or None
+            if articles_data:
+                search_type_used = 'catalogo locale'
+                stock_map = get_article_stock([a['codice'] for a in articles_data])
+                if stock_map is None:
+                    flash("Attenzione: Giacenze non aggiornate da Mexal, mostro gli ultimi valori sincronizzati.", "warning")
+                else:
+                    for art_summary in articles_data:
+                        art_summary.update(stock_map.get(art_summary['codice'], {}))
+            else:
+                print(f"Nessun risultato nel catalogo locale per '{query}', cerco su Mexal...")
+        if articles_data is None and is_likely_code:
             print("Ricerca per codice...")
             articles_data = search_articles_by_code(query) # Funzione API specifica
             search_type_used = 'codice'
@@ -2115,7 +3312,7 @@ def magazzino():
                  print(f"Nessun risultato per codice '{query}', tento ricerca per descrizione...")
                  articles_data = search_articles(query)
                  search_type_used = 'descrizione'
-        else:
+        elif articles_data is None:
              print("Ricerca per descrizione...")
              articles_data = search_articles(query)
              search_type_used = 'descrizione'
@@ -2126,6 +3323,8 @@ def magazzino():
              error_message = f"Nessun articolo trovato per '{query}' (cercato per {search_type_used})."
         else:
             print(f"Trovati {len(articles_data)} articoli. Recupero dettagli...")
+            # Prezzi di tutti i risultati in parallelo (una sola "attesa" invece di N)
+            prices_map = get_article_prices([a.get('codice') for a in articles_data], listino_id=4)
             processed_count = 0
             detail_errors = 0
             for art_summary in articles_data:
@@ -2133,15 +3332,19 @@ def magazzino():
                 if not codice_art:
                     continue
 
-                art_details = get_article_details(codice_art)
                 art = dict(art_summary)
 
-                if art_details:
-                    art['cod_alternativo'] = art_details.get('cod_alternativo', '')
+                # 'cod_alternativo' è già nei campi della ricerca: dettagli solo se manca
+                if 'cod_alternativo' in art_summary:
+                    art['cod_alternativo'] = art_summary.get('cod_alternativo') or ''
                 else:
-                    art['cod_alternativo'] = 'N/D'
-                    detail_errors += 1
-                    print(f"Errore nel recuperare dettagli per {codice_art}")
+                    art_details = get_article_details(codice_art)
+                    if art_details:
+                        art['cod_alternativo'] = art_details.get('cod_alternativo', '')
+                    else:
+                        art['cod_alternativo'] = 'N/D'
+                        detail_errors += 1
+                        print(f"Errore nel recuperare dettagli per {codice_art}")
 
                 try:
                     qta_carico = float(art.get('qta_carico', 0) or 0)
@@ -2151,7 +3354,7 @@ def magazzino():
                     esis = qta_carico - qta_scarico
                     disp_net = esis - ord_cli_e - ord_cli_sps
                     art['giacenza_netta'] = disp_net
-                    art['prezzo'] = get_article_price(codice_art, listino_id=4) if codice_art else 0.0
+                    art['prezzo'] = prices_map.get(codice_art, 0.0)
                     processed_count += 1
                 except (ValueError, TypeError, KeyError) as e:
                     print(f"Errore calcolo dati magazzino per articolo {codice_art}: {e}")
@@ -2186,6 +3389,7 @@ def update_alt_code_api():
     success = update_article_alt_code(article_code, alt_code)
     
     if success:
+        _catalog_update_alt_code(article_code, alt_code)
         return jsonify({'status': 'success', 'message': 'Codice alternativo aggiornato.'})
     else:
         return jsonify({'status': 'error', 'message': 'Errore API Mexal.'}), 500
@@ -2324,27 +3528,44 @@ def delete_todo(item_id):
         flash("Errore durante l'eliminazione.", "danger")
     return redirect(url_for('todo_list'))
 
-def get_cached_article_group(codice):
+def get_article_groups_bulk(codici):
     """
-    Funzione helper per il caching "lazy" dei gruppi merceologici.
-    Chiama l'API solo se il codice non è già in cache.
+    Gruppi merceologici per una lista di articoli senza chiamate per singolo articolo:
+    cache in memoria, poi catalogo locale, poi una sola ricerca 'in' su Mexal per i
+    codici rimasti. Restituisce {codice: gruppo} ('Nessun Gruppo' se assente).
     """
-    # 1. Prova a leggere dalla cache in memoria
-    if codice in _article_details_cache:
-        return _article_details_cache[codice]
-    
-    # 2. Se non c'è, chiama l'API (questo accadrà solo la prima volta)
-    print(f"Fabbisogno (Cache Miss): Chiamata API per dettagli art: {codice}")
-    details = get_article_details(codice)
-    
-    # 3. Salva in cache e restituisci
-    if details and details.get('cod_grp_merc'):
-        gruppo = details['cod_grp_merc'] or 'Nessun Gruppo'
-    else:
-        gruppo = 'Nessun Gruppo'
-        
-    _article_details_cache[codice] = gruppo
-    return gruppo
+    groups = {}
+    missing = []
+    for codice in dict.fromkeys(c for c in codici if c):
+        gruppo = _article_group_cache.get(codice)
+        if gruppo is not None:
+            groups[codice] = gruppo
+        else:
+            missing.append(codice)
+
+    if missing:
+        try:
+            for article in ArticleCatalog.query.filter(ArticleCatalog.codice.in_(missing)).all():
+                groups[article.codice] = article.cod_grp_merc or 'Nessun Gruppo'
+                _article_group_cache.set(article.codice, groups[article.codice])
+        except Exception as e:
+            print(f"ERRORE [get_article_groups_bulk]: Lettura catalogo locale fallita: {e}")
+        missing = [c for c in missing if c not in groups]
+
+    if missing:
+        print(f"Fabbisogno: {len(missing)} articoli fuori catalogo, ricerca gruppi in blocco su Mexal.")
+        remote_groups = get_article_groups(missing)
+        for codice in missing:
+            if remote_groups is None:
+                groups[codice] = 'Nessun Gruppo' # Non in cache: si riprova al prossimo calcolo
+            else:
+                groups[codice] = remote_groups.get(codice) or 'Nessun Gruppo'
+                _article_group_cache.set(codice, groups[codice])
+    return groups
+
+def get_cached_article_group(codice):
+    """Gruppo merceologico di un singolo articolo (vedi get_article_groups_bulk)."""
+    return get_article_groups_bulk([codice]).get(codice, 'Nessun Gruppo')
 
 @app.route('/fabbisogno')
 @login_required
@@ -2383,8 +3604,7 @@ def fabbisogno():
                 print(f"Fabbisogno: Filtro per giorno che termina con: '{giorno_da_cercare}'")
                 
                 ordini_del_giorno = [
-                    o for o in orders_map.values()
-                    if isinstance(o.get('data_documento'), str) and len(o['data_documento']) == 8 and o['data_documento'].endswith(giorno_da_cercare)
+                    orders_map[key] for key in get_order_indexes(orders_map)['by_day'].get(giorno_da_cercare, ())
                 ]
 
                 if not ordini_del_giorno:
@@ -2393,6 +3613,10 @@ def fabbisogno():
                     print(f"Fabbisogno: Trovati {len(ordini_del_giorno)} ordini. Inizio aggregazione...")
                     
                     # 1. Aggregazione
+                    # Gruppi di tutti gli articoli del giorno in blocco (nessuna chiamata per articolo)
+                    article_groups = get_article_groups_bulk(
+                        item.get('codice_articolo') for order in ordini_del_giorno for item in order.get('righe', [])
+                    )
                     grouped_data = {} # Dizionario temporaneo
                     for order in ordini_del_giorno:
                         cliente = order.get('ragione_sociale', 'Cliente Sconosciuto')
@@ -2401,7 +3625,7 @@ def fabbisogno():
                             codice = item.get('codice_articolo')
                             if not codice: continue
 
-                            gruppo = get_cached_article_group(codice)
+                            gruppo = article_groups.get(codice, 'Nessun Gruppo')
 
                             # --- MODIFICA LOGICA DI SOMMA ---
                             try: 
@@ -2529,10 +3753,18 @@ with app.app_context():
     try:
         print("Verifica/Creazione tabelle database all'avvio...")
         db.create_all()
+        _ensure_article_catalog_fts()
         print("Verifica/Creazione tabelle completata.")
     except Exception as e:
         print(f"ERRORE CRITICO durante creazione tabelle DB all'avvio: {e}")
 
+# --- Ripartenza a caldo: ultimo snapshot ordini salvato su disco ---
+# Servito subito (anche se non aggiornato) mentre il refresher recupera le modifiche con una sync delta
+_warm_start_begin = time.perf_counter()
+if _load_shared_snapshot():
+    print(f"Snapshot ordini caricato da disco in {(time.perf_counter() - _warm_start_begin) * 1000:.0f} ms: "
+          f"{len(_cache['snapshot']['orders_map'])} ordini del {_cache['snapshot']['loaded_at']:%d/%m %H:%M}.")
+
 
 # --- Avvio App ---
 if __name__ == '__main__':
@@ -1,10 +1,18 @@
 # mexal_api.py (Versione Corretta)
 
 import requests
+from requests.adapters import HTTPAdapter
 import os
 from dotenv import load_dotenv
 import time
+import threading
+import functools
+import copy
+from collections import OrderedDict
+import re
+from urllib.parse import urlsplit
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import json # Importa json per logging errori
 import urllib3
 
@@ -16,59 +24,458 @@ load_dotenv()
 # Recupera l'URL base dall'ambiente, con un default se non impostato
 API_BASE_URL = os.getenv('MX_API_BASE_URL', 'https://93.148.248.104:9004/webapi/')
 AUTH_TOKEN = os.getenv('MX_AUTH')
+COORDINATE_GESTIONALE = os.getenv('MX_COORDINATE_GESTIONALE', 'Azienda=SRL Anno=2025 Magazzino=3')
+
+# --- Trasporto HTTP condiviso (connessioni keep-alive riutilizzate) ---
+# Dimensione del pool di connessioni verso il server Mexal (per processo)
+MX_POOL_SIZE = int(os.getenv('MX_POOL_SIZE', '10'))
+# Timeout separati: connessione (handshake TCP/TLS) e lettura della risposta
+MX_CONNECT_TIMEOUT = float(os.getenv('MX_CONNECT_TIMEOUT', '5'))
+MX_READ_TIMEOUT = float(os.getenv('MX_READ_TIMEOUT', '45'))
+MX_TIMEOUT = (MX_CONNECT_TIMEOUT, MX_READ_TIMEOUT)
+
+# --- Resilienza: retry con backoff esponenziale e circuit breaker ---
+# Tentativi aggiuntivi per le sole chiamate idempotenti (GET e POST di ricerca)
+MX_MAX_RETRIES = int(os.getenv('MX_MAX_RETRIES', '2'))
+MX_BACKOFF_BASE = float(os.getenv('MX_BACKOFF_BASE', '0.5')) # Secondi, raddoppia a ogni tentativo
+MX_BACKOFF_MAX = float(os.getenv('MX_BACKOFF_MAX', '4'))
+# Dopo N fallimenti consecutivi le chiamate falliscono subito per MX_CB_COOLDOWN secondi
+MX_CB_FAILURE_THRESHOLD = int(os.getenv('MX_CB_FAILURE_THRESHOLD', '5'))
+MX_CB_COOLDOWN = float(os.getenv('MX_CB_COOLDOWN', '30'))
+
+# --- Proiezione campi (?fields=) per i caricamenti massivi ---
+# Solo le colonne effettivamente lette dall'app: riduce payload, parsing e memoria della cache.
+# Sovrascrivibili da ambiente (lista separata da virgole) se servono altri campi.
+CLIENT_FIELDS = os.getenv('MX_FIELDS_CLIENTI', 'codice,ragione_sociale,telefono,indirizzo,localita,cap,provincia')
+ORDER_FIELDS = os.getenv('MX_FIELDS_ORDINI', 'sigla,serie,numero,data_documento,cod_conto,cod_anag_sped,id_pagamento,nota,data_ult_mod')
+ORDER_ROW_FIELDS = os.getenv('MX_FIELDS_RIGHE', 'sigla,serie,numero,id_riga,codice_articolo,descr_articolo,cod_alternativo,nr_colli,quantita')
+# Catalogo articoli locale (ricerca magazzino): anagrafica + progressivi di giacenza
+ARTICLE_CATALOG_FIELDS = os.getenv('MX_FIELDS_ARTICOLI', 'codice,descrizione,descr_completa,cod_alternativo,cod_grp_merc,qta_carico,qta_scarico,ord_cli_e,ord_cli_sps')
+SHIPPING_ADDRESS_FIELDS = 'id,cod_conto,descrizione,indirizzo,localita,cap,provincia,telefono1,nazione'
+# Solo i progressivi per la giacenza netta (non cambiano data_ult_mod: vanno letti al momento)
+ARTICLE_STOCK_FIELDS = 'codice,qta_carico,qta_scarico,ord_cli_e,ord_cli_sps'
+# Per i controlli di aggiornamento basta sapere se esistono record
+ORDER_KEY_FIELDS = 'sigla,serie,numero'
+# Record per pagina nelle ricerche paginate (parametro 'max' della webapi)
+MX_PAGE_SIZE = int(os.getenv('MX_PAGE_SIZE', '500'))
+# Valori per singola ricerca 'in' (tiene il corpo della POST di dimensioni ragionevoli)
+MX_IN_CHUNK_SIZE = int(os.getenv('MX_IN_CHUNK_SIZE', '200'))
+
+# URL base normalizzato una sola volta (termina sempre con '/')
+_BASE_URL = API_BASE_URL.rstrip('/') + '/'
+_session = None
+_session_lock = threading.Lock()
+
+# --- Cache dati aggiuntivi per cliente (orari di consegna, cambiano raramente) ---
+DATI_AGGIUNTIVI_TTL = int(os.getenv('MX_DATI_AGGIUNTIVI_TTL', '3600')) # Secondi
+# Thread paralleli per il prefetch (limitati dalla dimensione del pool HTTP)
+PREFETCH_WORKERS = max(1, min(int(os.getenv('MX_PREFETCH_WORKERS', '8')), MX_POOL_SIZE))
+_dati_aggiuntivi_cache = {} # {client_code: (timestamp, dati)}
+_dati_aggiuntivi_lock = threading.Lock()
+
+# --- Cache TTL per dati di riferimento che cambiano raramente (secondi) ---
+MX_TTL_VETTORI = int(os.getenv('MX_TTL_VETTORI', '3600'))
+MX_TTL_PAGAMENTI = int(os.getenv('MX_TTL_PAGAMENTI', '3600'))
+MX_TTL_PREZZI = int(os.getenv('MX_TTL_PREZZI', '900'))
+MX_TTL_ARTICOLI = int(os.getenv('MX_TTL_ARTICOLI', '1800'))
+MX_MAX_ARTICOLI = int(os.getenv('MX_MAX_ARTICOLI', '5000')) # Voci massime in cache per i dati articolo
+_ttl_cached_functions = {} # {nome: wrapper o LRUCache}, per statistiche e invalidazione
+
+# --- Metriche delle chiamate Mexal (per template di endpoint) ---
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_ENDPOINT_TEMPLATES = [
+    (re.compile(r'^risorse/clienti/[^/]+/dati-aggiuntivi$'), 'risorse/clienti/{codice}/dati-aggiuntivi'),
+    (re.compile(r'^risorse/articoli/(?!ricerca$)[^/]+$'), 'risorse/articoli/{codice}'),
+]
+_metrics = {} # {template: {calls, errors, bytes, seconds_sum, buckets, routes}}
+_metrics_lock = threading.Lock()
+# Riepilogo della richiesta web corrente (impostato dall'app, propagato ai thread di prefetch)
+_request_metrics = threading.local()
 
 # Ignora gli warning relativi ai certificati SSL se proprio non puoi verificarli (SCONSIGLIATO IN PRODUZIONE)
 # import urllib3
 # urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def mx_call_api(endpoint, method='GET', data=None):
-    """
-    Funzione centralizzata per effettuare chiamate all'API Mexal.
+class MexalAPIError(Exception):
+    """Errore in una chiamata Mexal che il chiamante non può ignorare (es. pagina mancante)."""
 
-    Args:
-        endpoint (str): Il percorso dell'endpoint API (es. 'risorse/clienti/ricerca').
-        method (str, optional): Metodo HTTP ('GET' o 'POST'). Default 'GET'.
-        data (dict, optional): Payload JSON per richieste POST. Default None.
 
-    Returns:
-        dict or None: Il JSON della risposta API in caso di successo, None in caso di errore.
+def _build_url(endpoint):
+    """Compone l'URL completo partendo dall'endpoint relativo (gli URL assoluti restano invariati)."""
+    if endpoint.startswith(('http://', 'https://')):
+        return endpoint
+    return f"{_BASE_URL}{endpoint.lstrip('/')}"
+
+def with_fields(endpoint, fields):
+    """Aggiunge la proiezione '?fields=' a un endpoint di ricerca."""
+    if not fields:
+        return endpoint
+    separator = '&' if '?' in endpoint else '?'
+    return f"{endpoint}{separator}fields={fields}"
+
+def _get_session():
     """
-    if not AUTH_TOKEN:
-        print("Errore: Il token di autenticazione MX_AUTH non è stato configurato.")
-        return None
+    Restituisce la Session HTTP condivisa del modulo, creandola al primo uso.
+    La creazione è pigra così ogni worker gunicorn (dopo il fork) ha il suo pool.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MX_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Authorization': f'Passepartout {AUTH_TOKEN}',
+                    'Coordinate-Gestionale': COORDINATE_GESTIONALE,
+                    'Content-Type': 'application/json;charset=utf-8',
+                    'Connection': 'keep-alive'
+                })
+                session.verify = False # Come prima: certificato del server non verificabile
+                _session = session
+    return _session
+
+class _CircuitBreaker:
+    """
+    Circuit breaker minimale e thread-safe per il server Mexal.
+    Dopo 'failure_threshold' errori di rete consecutivi si apre e blocca le chiamate
+    per 'cooldown' secondi; poi lascia passare un tentativo (half-open): se riesce
+    si richiude, se fallisce resta aperto per un altro periodo.
+    """
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at >= self.cooldown:
+                self._opened_at = time.time() # Half-open: un solo tentativo per periodo
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print("INFO [circuit_breaker]: Mexal di nuovo raggiungibile, circuito chiuso.")
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"WARN [circuit_breaker]: {self._failures} errori consecutivi. Chiamate Mexal sospese per {self.cooldown}s.")
+                self._opened_at = time.time()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.time() - self._opened_at < self.cooldown
+
+
+_circuit_breaker = _CircuitBreaker(MX_CB_FAILURE_THRESHOLD, MX_CB_COOLDOWN)
+
+def is_mexal_available():
+    """False se il circuit breaker è aperto (Mexal considerato irraggiungibile)."""
+    return not _circuit_breaker.is_open
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate concorrenti identiche ("single-flight"):
+    per ogni chiave esegue una sola chiamata alla volta; gli altri thread che
+    chiedono la stessa chiave attendono e ricevono lo stesso risultato (con
+    copy_result=True una copia profonda, per risultati che i chiamanti modificano).
+    """
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, copy_result=False):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._copy_result = copy_result
+
+    def in_flight(self, key):
+        """True se una chiamata per 'key' è già in corso."""
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = SingleFlight._Call()
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result) if self._copy_result else call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
 
-    headers = {
-        'Authorization': f'Passepartout {AUTH_TOKEN}',
-        'Coordinate-Gestionale': 'Azienda=SRL Anno=2025 Magazzino=3', # NOTA: Potrebbe essere reso configurabile
-        'Content-Type': 'application/json;charset=utf-8'
-    }
 
-    # Assicura che l'URL base termini con '/' e l'endpoint non inizi con '/'
-    clean_base_url = API_BASE_URL.rstrip('/') + '/'
-    clean_endpoint = endpoint.lstrip('/')
-    full_url = f"{clean_base_url}{clean_endpoint}"
+# Le risposte JSON vengono modificate dai chiamanti (es. testate arricchite in place)
+_api_flight = SingleFlight(copy_result=True)
 
+def ttl_cache(ttl):
+    """
+    Decoratore: memorizza il risultato della funzione per 'ttl' secondi, per argomenti.
+    I risultati vuoti o None (tipici di un errore API) non vengono memorizzati.
+    Ogni chiamante riceve una copia propria: modificarla non altera la cache.
+    Il wrapper espone invalidate() e cache_stats().
+    """
+    def decorator(func):
+        entries = {} # {args: (timestamp, valore)}
+        stats = {'hits': 0, 'misses': 0}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                entry = entries.get(args)
+                if entry and time.time() - entry[0] < ttl:
+                    stats['hits'] += 1
+                    return copy.deepcopy(entry[1])
+                stats['misses'] += 1
+            value = func(*args)
+            if value:
+                with lock:
+                    entries[args] = (time.time(), copy.deepcopy(value))
+            return value
+
+        def invalidate():
+            with lock:
+                entries.clear()
+
+        def cache_stats():
+            with lock:
+                return {'ttl': ttl, 'entries': len(entries), **stats}
+
+        wrapper.invalidate = invalidate
+        wrapper.cache_stats = cache_stats
+        _ttl_cached_functions[func.__name__] = wrapper
+        return wrapper
+    return decorator
+
+class LRUCache:
+    """
+    Cache limitata e thread-safe: al massimo max_entries voci, scartate in ordine di
+    utilizzo meno recente; con ttl (secondi) le voci più vecchie sono considerate assenti.
+    Si registra tra le cache con statistiche (get_cache_stats / invalidate_cache).
+    """
+    _MISSING = object()
+
+    def __init__(self, name, max_entries, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # {chiave: (timestamp, valore)}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        _ttl_cached_functions[name] = self
+
+    def get(self, key, default=None):
+        """Restituisce il valore in cache (aggiornandone l'uso) o default se assente/scaduto."""
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is not self._MISSING and (self.ttl is None or time.time() - entry[0] < self.ttl):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            if entry is not self._MISSING:
+                del self._entries[key] # Scaduta
+            self._stats['misses'] += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key=_MISSING):
+        """Rimuove una voce, o tutte se key non è indicata."""
+        with self._lock:
+            if key is self._MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def cache_stats(self):
+        with self._lock:
+            return {'ttl': self.ttl, 'entries': len(self._entries), 'max_entries': self.max_entries, **self._stats}
+
+_article_cache = LRUCache('article_details', MX_MAX_ARTICOLI, ttl=MX_TTL_ARTICOLI) # {codice: dettagli}
+_price_cache = LRUCache('article_prices', MX_MAX_ARTICOLI, ttl=MX_TTL_PREZZI) # {(codice, listino, giorno): prezzo}
+
+def invalidate_cache(name=None):
+    """Svuota la cache TTL di una funzione (per nome) o di tutte se name è None."""
+    for func_name, wrapper in _ttl_cached_functions.items():
+        if name is None or func_name == name:
+            wrapper.invalidate()
+
+def get_cache_stats():
+    """Restituisce {nome cache: {ttl, entries, hits, misses, ...}} per tutte le cache registrate."""
+    return {name: wrapper.cache_stats() for name, wrapper in _ttl_cached_functions.items()}
+
+def _endpoint_template(endpoint):
+    """Riduce un endpoint (anche URL assoluto) al suo template, senza query e codici variabili."""
+    path = urlsplit(endpoint).path.lstrip('/')
+    base_path = urlsplit(_BASE_URL).path.lstrip('/')
+    if base_path and path.startswith(base_path):
+        path = path[len(base_path):]
+    for pattern, template in _ENDPOINT_TEMPLATES:
+        if pattern.match(path):
+            return template
+    return path
+
+def begin_request_metrics(route):
+    """Inizia il conteggio delle chiamate Mexal per la richiesta web corrente."""
+    _request_metrics.summary = {'route': route, 'calls': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0}
+
+def end_request_metrics():
+    """Chiude il conteggio per la richiesta corrente e restituisce il riepilogo (o None)."""
+    summary = getattr(_request_metrics, 'summary', None)
+    _request_metrics.summary = None
+    return summary
+
+def _current_request_metrics():
+    return getattr(_request_metrics, 'summary', None)
+
+def _record_call(endpoint, seconds, response_bytes, error):
+    """Registra una chiamata nelle metriche globali e nel riepilogo della richiesta corrente."""
+    template = _endpoint_template(endpoint)
+    summary = _current_request_metrics()
+    route = summary['route'] if summary else 'background'
+    with _metrics_lock:
+        entry = _metrics.setdefault(template, {
+            'calls': 0, 'errors': 0, 'bytes': 0, 'seconds_sum': 0.0,
+            'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'routes': {}
+        })
+        entry['calls'] += 1
+        entry['bytes'] += response_bytes
+        entry['routes'][route] = entry['routes'].get(route, 0) + 1
+        if error:
+            entry['errors'] += 1
+        if seconds is not None:
+            entry['seconds_sum'] += seconds
+            bucket = next((i for i, limit in enumerate(LATENCY_BUCKETS) if seconds <= limit), len(LATENCY_BUCKETS))
+            entry['buckets'][bucket] += 1
+        if summary is not None:
+            summary['calls'] += 1
+            summary['bytes'] += response_bytes
+            summary['seconds'] += seconds or 0.0
+            if error:
+                summary['errors'] += 1
+
+def get_call_metrics():
+    """Copia delle metriche correnti: {template: {calls, errors, bytes, seconds_sum, buckets, routes}}."""
+    with _metrics_lock:
+        return {t: {**m, 'buckets': list(m['buckets']), 'routes': dict(m['routes'])} for t, m in _metrics.items()}
+
+def render_metrics_prometheus():
+    """Metriche Mexal (chiamate, errori, latenza, byte, cache, circuit breaker) in formato testo Prometheus."""
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = [
+        '# HELP mexal_api_calls_total Chiamate HTTP verso Mexal per endpoint e rotta Flask.',
+        '# TYPE mexal_api_calls_total counter',
+    ]
+    metrics = get_call_metrics()
+    for template, m in sorted(metrics.items()):
+        for route, count in sorted(m['routes'].items()):
+            lines.append(f'mexal_api_calls_total{{endpoint="{label(template)}",route="{label(route)}"}} {count}')
+    lines += ['# HELP mexal_api_errors_total Chiamate Mexal fallite.', '# TYPE mexal_api_errors_total counter']
+    for template, m in sorted(metrics.items()):
+        lines.append(f'mexal_api_errors_total{{endpoint="{label(template)}"}} {m["errors"]}')
+    lines += ['# HELP mexal_api_response_bytes_total Byte ricevuti da Mexal.', '# TYPE mexal_api_response_bytes_total counter']
+    for template, m in sorted(metrics.items()):
+        lines.append(f'mexal_api_response_bytes_total{{endpoint="{label(template)}"}} {m["bytes"]}')
+    lines += ['# HELP mexal_api_latency_seconds Latenza delle chiamate Mexal.', '# TYPE mexal_api_latency_seconds histogram']
+    for template, m in sorted(metrics.items()):
+        cumulative = 0
+        for limit, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], m['buckets']):
+            cumulative += count
+            lines.append(f'mexal_api_latency_seconds_bucket{{endpoint="{label(template)}",le="{limit}"}} {cumulative}')
+        lines.append(f'mexal_api_latency_seconds_sum{{endpoint="{label(template)}"}} {m["seconds_sum"]:.6f}')
+        lines.append(f'mexal_api_latency_seconds_count{{endpoint="{label(template)}"}} {cumulative}')
+    lines += ['# HELP mexal_cache_requests_total Accessi alle cache dei dati Mexal.', '# TYPE mexal_cache_requests_total counter']
+    for name, stats in sorted(get_cache_stats().items()):
+        lines.append(f'mexal_cache_requests_total{{cache="{label(name)}",result="hit"}} {stats["hits"]}')
+        lines.append(f'mexal_cache_requests_total{{cache="{label(name)}",result="miss"}} {stats["misses"]}')
+    lines += ['# HELP mexal_cache_evictions_total Voci scartate per limite di dimensione.', '# TYPE mexal_cache_evictions_total counter']
+    for name, stats in sorted(get_cache_stats().items()):
+        if 'evictions' in stats:
+            lines.append(f'mexal_cache_evictions_total{{cache="{label(name)}"}} {stats["evictions"]}')
+    lines += ['# HELP mexal_circuit_breaker_open 1 se le chiamate Mexal sono sospese.', '# TYPE mexal_circuit_breaker_open gauge']
+    lines.append(f'mexal_circuit_breaker_open {0 if is_mexal_available() else 1}')
+    return '\n'.join(lines) + '\n'
+
+def _is_idempotent(method, endpoint):
+    """GET e POST sulle risorse di ricerca possono essere ripetuti senza effetti collaterali."""
+    if method == 'GET':
+        return True
+    return method == 'POST' and '/ricerca' in endpoint.split('?')[0]
+
+def _mx_send(method, full_url, data):
+    """
+    Esegue un singolo tentativo di chiamata.
+    Restituisce (json_or_None, guasto, retryable, bytes_ricevuti): guasto è True se Mexal non ha
+    risposto o ha risposto 5xx/429 (conta per il circuit breaker); retryable solo per gli errori
+    transitori per cui ha senso ritentare (connessione, connect timeout, 5xx/429). Un read timeout
+    è un guasto ma non si ritenta: il server è bloccato e ogni tentativo costerebbe MX_READ_TIMEOUT.
+    """
+    session = _get_session()
     try:
         # --- CORREZIONE 2: Rimuovi verify=False ---
         # NOTA: Assicurati che il server API abbia un certificato valido
         # o fornisci il percorso a un certificato CA/autofirmato con verify='/path/to/cert.pem'
         # Per ora lasciamo verify=True (default)
-        print(f"Chiamata API: {method.upper()} {full_url}") # Log della chiamata
-        if method.upper() == 'POST':
-            response = requests.post(full_url, headers=headers, json=data, timeout=45, verify=False) # Rimosso verify=False
+        print(f"Chiamata API: {method} {full_url}") # Log della chiamata
+        if method == 'POST':
+            response = session.post(full_url, json=data, timeout=MX_TIMEOUT)
         else:
-            response = requests.get(full_url, headers=headers, timeout=45, verify=False) # Rimosso verify=False
+            response = session.get(full_url, timeout=MX_TIMEOUT)
 
         response.raise_for_status() # Controlla errori HTTP (4xx, 5xx)
-        return response.json()
+        return response.json(), False, False, len(response.content)
 
+    except requests.exceptions.ReadTimeout:
+        print(f"Errore: Timeout in lettura nella chiamata all'API in {full_url}")
+        return None, True, False, 0
     except requests.exceptions.Timeout:
         print(f"Errore: Timeout nella chiamata all'API in {full_url}")
-        return None
+        return None, True, True, 0
     except requests.exceptions.SSLError as e:
         print(f"Errore SSL nella chiamata all'API in {full_url}: {e}")
         print(">> Assicurati che il certificato del server sia valido o configura 'verify' in requests.")
-        return None
+        return None, True, False, 0
+    except requests.exceptions.ConnectionError as e:
+        print(f"Errore di connessione nella chiamata all'API in {full_url}: {e}")
+        return None, True, True, 0
     except requests.exceptions.RequestException as e:
         print(f"Errore generico nella chiamata all'API in {full_url}: {e}")
         error_details = "Nessun dettaglio disponibile."
@@ -79,14 +486,118 @@ def mx_call_api(endpoint, method='GET', data=None):
             except Exception:
                 pass # Non fa nulla se non riesce a leggere il body
             print(f"!!! DETTAGLI DELL'ERRORE DEL SERVER ({e.response.status_code}): {error_details} !!!")
-        return None
+            server_error = e.response.status_code >= 500 or e.response.status_code == 429
+            return None, server_error, server_error, len(e.response.content or b'')
+        return None, False, False, 0
     except json.JSONDecodeError as e:
         print(f"Errore: Risposta non JSON dall'API in {full_url}: {e}")
         # Mostra l'inizio della risposta per debug, ma attenzione a dati sensibili
         print(f"Risposta ricevuta (inizio): {response.text[:200]}...")
+        return None, False, False, 0
+
+def _mx_request_once(method, full_url, data, endpoint):
+    """Singolo tentativo di chiamata, con registrazione delle metriche."""
+    started = time.perf_counter()
+    result, failed, retryable, response_bytes = _mx_send(method, full_url, data)
+    _record_call(endpoint, time.perf_counter() - started, response_bytes, error=result is None)
+    return result, failed, retryable
+
+def mx_call_api(endpoint, method='GET', data=None):
+    """
+    Funzione centralizzata per effettuare chiamate all'API Mexal.
+
+    Args:
+        endpoint (str): Il percorso dell'endpoint API (es. 'risorse/clienti/ricerca').
+        method (str, optional): Metodo HTTP ('GET' o 'POST'). Default 'GET'.
+        data (dict, optional): Payload JSON per richieste POST. Default None.
+
+    Returns:
+        dict or None: Il JSON della risposta API in caso di successo, None in caso di errore.
+    """
+    if not AUTH_TOKEN:
+        print("Errore: Il token di autenticazione MX_AUTH non è stato configurato.")
         return None
 
+    method = method.upper()
+    if not _is_idempotent(method, endpoint):
+        return _mx_call_with_retries(endpoint, method, data)
+
+    # Chiamate di sola lettura identiche e concorrenti: ne parte una sola
+    flight_key = (method, endpoint, json.dumps(data, sort_keys=True, default=str))
+    return _api_flight.do(flight_key, _mx_call_with_retries, endpoint, method, data)
+
+
+def _mx_call_with_retries(endpoint, method, data):
+    """Esegue la chiamata con circuit breaker e retry (solo per le chiamate idempotenti)."""
+    full_url = _build_url(endpoint)
 
+    if not _circuit_breaker.allow_request():
+        print(f"Errore: Mexal non raggiungibile (circuit breaker aperto), chiamata saltata: {method} {full_url}")
+        _record_call(endpoint, None, 0, error=True)
+        return None
+
+    attempts = 1 + (MX_MAX_RETRIES if _is_idempotent(method, endpoint) else 0)
+    for attempt in range(1, attempts + 1):
+        result, failed, retryable = _mx_request_once(method, full_url, data, endpoint)
+        if not failed:
+            # Il server ha risposto (anche con un errore applicativo): il collegamento funziona
+            _circuit_breaker.record_success()
+            return result
+
+        _circuit_breaker.record_failure()
+        if not retryable or attempt >= attempts or not _circuit_breaker.allow_request():
+            break
+        delay = min(MX_BACKOFF_MAX, MX_BACKOFF_BASE * (2 ** (attempt - 1)))
+        print(f"Ritento {method} {full_url} tra {delay:.1f}s (tentativo {attempt + 1}/{attempts})...")
+        time.sleep(delay)
+
+    return None
+
+
+def mx_iter_search(endpoint, filtri=None, fields=None, page_size=None):
+    """
+    Generatore sulle risorse di ricerca Mexal ('.../ricerca'): scarica i risultati
+    a pagine di 'page_size' record e li restituisce uno alla volta, così il
+    chiamante può costruire le sue mappe mentre i dati arrivano.
+
+    La pagina successiva è indicata dal campo 'next' della risposta; se il server
+    non pagina (nessun 'next'), il generatore termina dopo la prima risposta.
+
+    Raises:
+        MexalAPIError: se una pagina non può essere recuperata (dati parziali).
+    """
+    page_size = page_size or MX_PAGE_SIZE
+    payload = {'filtri': filtri or []}
+    page_endpoint = with_fields(endpoint, fields)
+    page_endpoint += ('&' if '?' in page_endpoint else '?') + f"max={page_size}"
+    page_number = 0
+
+    while page_endpoint:
+        response = mx_call_api(page_endpoint, method='POST', data=payload)
+        if not response or not isinstance(response.get('dati'), list):
+            raise MexalAPIError(f"Pagina {page_number + 1} non disponibile per {endpoint}")
+        page_number += 1
+        yield from response['dati']
+        # Rilascia subito la pagina: in memoria resta solo quella corrente
+        page_endpoint = response.get('next') or None
+        del response
+
+def mx_iter_search_in(endpoint, campo, valori, fields=None, filtri=None):
+    """
+    Come mx_iter_search, ma limitato ai record con 'campo' in 'valori': una ricerca
+    con condizione 'in' ogni MX_IN_CHUNK_SIZE valori distinti (più gli eventuali filtri).
+
+    Raises:
+        MexalAPIError: se una pagina non può essere recuperata (dati parziali).
+    """
+    distinct_values = list(dict.fromkeys(v for v in valori if v not in (None, '')))
+    for start in range(0, len(distinct_values), MX_IN_CHUNK_SIZE):
+        chunk = distinct_values[start:start + MX_IN_CHUNK_SIZE]
+        chunk_filtri = [{'campo': campo, 'condizione': 'in', 'valore': chunk}] + list(filtri or [])
+        yield from mx_iter_search(endpoint, filtri=chunk_filtri, fields=fields)
+
+
+@ttl_cache(MX_TTL_VETTORI)
 def get_vettori():
     """Recupera i fornitori che sono definiti come vettori (BOXER, EXPERT)."""
     endpoint = 'risorse/fornitori/ricerca'
@@ -151,11 +662,11 @@ def get_shipping_address(address_id):
     else: # response is None
         return None # Errore API già loggato
 
-def get_dati_aggiuntivi(client_code):
-    """Recupera i dati aggiuntivi per un cliente specifico."""
-    if not client_code:
-        return {}
-
+def _fetch_dati_aggiuntivi(client_code):
+    """
+    Recupera da Mexal i dati aggiuntivi per un cliente specifico.
+    Restituisce None se la chiamata fallisce (così l'errore non finisce in cache).
+    """
     # --- CORREZIONE 5: Aggiunto commento su endpoint e encoding ---
     # NOTA: Verifica se questo endpoint è corretto e se la codifica hex è necessaria.
     # La codifica hex è richiesta solo se client_code contiene '/' o '\' [cite: 650-651].
@@ -181,17 +692,82 @@ def get_dati_aggiuntivi(client_code):
             else:
                  print(f"Formato dati aggiuntivi inatteso per cliente {client_code}: {type(dati)}")
                  return {}
-        # Se la risposta è None (errore API) o non contiene 'dati' o 'dati' è None
+        elif response is None:
+            return None # Errore API già loggato
+        # La risposta non contiene 'dati' o 'dati' è None
         else:
-             if response is not None: # Logga solo se c'è stata una risposta (anche vuota)
-                 print(f"Nessun dato aggiuntivo trovato o errore API per cliente {client_code}, risposta: {response}")
-             return {} # Ritorna dict vuoto in caso di errore o dato mancante
+             print(f"Nessun dato aggiuntivo trovato per cliente {client_code}, risposta: {response}")
+             return {} # Ritorna dict vuoto se il dato manca
 
     except Exception as e:
         print(f"Errore generico durante recupero/encoding dati aggiuntivi per {client_code}: {e}")
+        return None
+
+def get_dati_aggiuntivi(client_code):
+    """Recupera i dati aggiuntivi per un cliente specifico (con cache per cliente)."""
+    if not client_code:
         return {}
 
+    now = time.time()
+    with _dati_aggiuntivi_lock:
+        cached = _dati_aggiuntivi_cache.get(client_code)
+    if cached and now - cached[0] < DATI_AGGIUNTIVI_TTL:
+        return cached[1]
+
+    dati = _fetch_dati_aggiuntivi(client_code)
+    if dati is None:
+        # Errore API: meglio un dato scaduto che nessun dato
+        return cached[1] if cached else {}
+
+    with _dati_aggiuntivi_lock:
+        _dati_aggiuntivi_cache[client_code] = (time.time(), dati)
+    return dati
+
+def _run_concurrently(fn, items):
+    """
+    Esegue fn(item) per ogni elemento su un pool limitato di thread (PREFETCH_WORKERS)
+    e restituisce i risultati nello stesso ordine. Le chiamate Mexal dei thread
+    contano nelle metriche della richiesta web che le ha avviate.
+    """
+    request_metrics = _current_request_metrics()
+
+    def run(item):
+        _request_metrics.summary = request_metrics
+        try:
+            return fn(item)
+        finally:
+            _request_metrics.summary = None
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        return list(executor.map(run, items))
 
+def prefetch_dati_aggiuntivi(client_codes):
+    """
+    Recupera i dati aggiuntivi per un insieme di clienti, una sola volta per cliente.
+    I codici non presenti (o scaduti) in cache vengono scaricati in parallelo
+    con un numero limitato di thread. Restituisce {client_code: dati}.
+    """
+    distinct_codes = {code for code in client_codes if code}
+    now = time.time()
+    with _dati_aggiuntivi_lock:
+        to_fetch = [
+            code for code in distinct_codes
+            if code not in _dati_aggiuntivi_cache or now - _dati_aggiuntivi_cache[code][0] >= DATI_AGGIUNTIVI_TTL
+        ]
+
+    if to_fetch:
+        print(f"DEBUG [prefetch_dati_aggiuntivi]: {len(distinct_codes)} clienti, {len(to_fetch)} da scaricare ({PREFETCH_WORKERS} thread).")
+        _run_concurrently(get_dati_aggiuntivi, to_fetch)
+
+    # Legge dalla cache senza ritentare i clienti falliti (restano con {})
+    with _dati_aggiuntivi_lock:
+        return {
+            code: _dati_aggiuntivi_cache[code][1] if code in _dati_aggiuntivi_cache else {}
+            for code in distinct_codes
+        }
+
+
+@ttl_cache(MX_TTL_PAGAMENTI)
 def get_payment_methods():
     """Recupera l'elenco dei metodi di pagamento."""
     endpoint = 'risorse/dati-generali/pagamenti/ricerca'
@@ -336,14 +912,40 @@ def find_article_code_by_alt_code(alt_code_value):
 # --- FINE NUOVA FUNZIONE ---
 
 def get_article_price(codice_articolo, listino_id=4):
-    """Recupera il prezzo di un articolo usando il servizio 'condizioni_documento'."""
+    """
+    Recupera il prezzo di un articolo usando il servizio 'condizioni_documento'.
+    Il prezzo è memorizzato per (articolo, listino, giorno) per MX_TTL_PREZZI secondi.
+    """
     if not codice_articolo:
         print("Errore get_article_price: codice_articolo mancante.")
         return 0.0
 
-    endpoint = 'servizi' # Corretto, è un servizio
-
     today_date = datetime.now().strftime('%Y%m%d')
+    cache_key = (codice_articolo, listino_id, today_date)
+    cached = _price_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    price = _fetch_article_price(codice_articolo, listino_id, today_date)
+    if price is None:
+        return 0.0 # Errore API: non memorizzato, si ritenta alla prossima richiesta
+    _price_cache.set(cache_key, price)
+    return price
+
+def get_article_prices(codici_articolo, listino_id=4):
+    """
+    Recupera i prezzi di più articoli: quelli non in cache vengono richiesti
+    in parallelo (thread limitati). Restituisce {codice_articolo: prezzo}.
+    """
+    distinct_codes = list(dict.fromkeys(code for code in codici_articolo if code))
+    if not distinct_codes:
+        return {}
+    prices = _run_concurrently(lambda code: get_article_price(code, listino_id), distinct_codes)
+    return dict(zip(distinct_codes, prices))
+
+def _fetch_article_price(codice_articolo, listino_id, today_date):
+    """Chiama 'condizioni_documento'; restituisce il prezzo o None se la chiamata fallisce."""
+    endpoint = 'servizi' # Corretto, è un servizio
     # NOTA: Verifica che '501.00085' sia un codice cliente valido/appropriato per questo scopo
     default_client = "501.00085" # Citato nel manuale (pag. 52) [cite: 2051], ma assicurati sia corretto nel tuo contesto
 
@@ -372,20 +974,71 @@ def get_article_price(codice_articolo, listino_id=4):
         except (ValueError, TypeError):
              print(f"Errore: Prezzo ricevuto non è un numero valido per {codice_articolo}: {response.get('prezzo')}")
              return 0.0
-    # Se response è None (errore API) o non è un dizionario o non contiene 'prezzo', ritorna 0.0
+    elif response is None:
+        return None # Errore API già loggato
+    # Risposta non valida o senza 'prezzo': prezzo 0.0
     else:
-        if response is not None: # Logga solo se c'è stata una risposta (ma non valida)
-            print(f"Prezzo non trovato o risposta API non valida per {codice_articolo}, risposta: {response}")
+        print(f"Prezzo non trovato o risposta API non valida per {codice_articolo}, risposta: {response}")
         return 0.0
     
 def get_article_details(codice_articolo):
     """
     Recupera i dettagli completi di un singolo articolo.
-    Aggiunta stampa per debug.
+    I dettagli validi restano in cache per MX_TTL_ARTICOLI secondi
+    (invalidati da update_article_alt_code).
     """
     if not codice_articolo:
         return None
 
+    cached = _article_cache.get(codice_articolo)
+    if cached is not None:
+        return cached
+
+    details = _fetch_article_details(codice_articolo)
+    if details is not None:
+        _article_cache.set(codice_articolo, details)
+    return details
+
+def invalidate_article_details(codice_articolo=None):
+    """Rimuove un articolo dalla cache dei dettagli (o tutti se codice_articolo è None)."""
+    if codice_articolo is None:
+        _article_cache.invalidate()
+    else:
+        _article_cache.invalidate(codice_articolo)
+
+def get_article_groups(codici_articolo):
+    """
+    Gruppi merceologici di più articoli con una ricerca 'in' su articoli/ricerca
+    (a blocchi di MX_IN_CHUNK_SIZE codici) invece di un GET per articolo.
+    Restituisce {codice: cod_grp_merc}; None se una ricerca fallisce.
+    """
+    groups = {}
+    try:
+        for article in mx_iter_search_in('risorse/articoli/ricerca', 'codice', codici_articolo, fields='codice,cod_grp_merc'):
+            if article.get('codice'):
+                groups[article['codice']] = article.get('cod_grp_merc') or ''
+    except MexalAPIError as e:
+        print(f"ERRORE [get_article_groups]: {e}")
+        return None
+    return groups
+
+def get_article_stock(codici_articolo):
+    """
+    Progressivi di giacenza aggiornati (ARTICLE_STOCK_FIELDS) di più articoli con una
+    ricerca 'in' su articoli/ricerca. Restituisce {codice: dict}; None se la ricerca fallisce.
+    """
+    stock = {}
+    try:
+        for article in mx_iter_search_in('risorse/articoli/ricerca', 'codice', codici_articolo, fields=ARTICLE_STOCK_FIELDS):
+            if article.get('codice'):
+                stock[article['codice']] = article
+    except MexalAPIError as e:
+        print(f"ERRORE [get_article_stock]: {e}")
+        return None
+    return stock
+
+def _fetch_article_details(codice_articolo):
+    """Chiamata GET all'anagrafica articolo. Aggiunta stampa per debug."""
     endpoint = f'risorse/articoli/{codice_articolo}'
     #print(f"DEBUG: Chiamata GET a {API_BASE_URL}{endpoint}") # Stampa URL
     response = mx_call_api(endpoint, method='GET')
@@ -435,15 +1088,20 @@ def update_article_alt_code(codice_articolo, new_alt_code):
     # Modifichiamo temporaneamente mx_call_api per ritornare l'intera response per PUT/DELETE
     # OPPURE creiamo una funzione helper specifica per PUT/DELETE. Scegliamo la seconda.
 
-    headers = {
-        'Authorization': f'Passepartout {AUTH_TOKEN}',
-        'Coordinate-Gestionale': 'Azienda=SRL Anno=2025 Magazzino=3', # Assicurati che siano corrette
-        'Content-Type': 'application/json;charset=utf-8'
-    }
-    full_url = f"{API_BASE_URL}{endpoint}"
+    if not AUTH_TOKEN:
+        print("ERRORE [update_alt_code]: Il token di autenticazione MX_AUTH non è stato configurato.")
+        return False
+
+    full_url = _build_url(endpoint)
 
+    if not _circuit_breaker.allow_request():
+        print(f"ERRORE [update_alt_code]: Mexal non raggiungibile (circuit breaker aperto), PUT saltata per {codice_articolo}.")
+        return False
+
+    started = time.perf_counter()
+    response = None
     try:
-        response = requests.put(full_url, headers=headers, json=payload, timeout=45, verify=False) # verify=True è default
+        response = _get_session().put(full_url, json=payload, timeout=MX_TIMEOUT)
 
         print(f"DEBUG [update_alt_code]: Risposta API Status Code: {response.status_code}")
         # DEBUG: Stampa il corpo della risposta SE non è 204 per capire l'errore
@@ -453,8 +1111,10 @@ def update_article_alt_code(codice_articolo, new_alt_code):
         response.raise_for_status() # Solleva eccezione per 4xx/5xx
 
         # Se arriva qui, lo status code era 2xx (ci aspettiamo 204)
+        _circuit_breaker.record_success()
         if response.status_code == 204:
             print(f"INFO [update_alt_code]: Aggiornamento cod_alternativo per {codice_articolo} riuscito.")
+            invalidate_article_details(codice_articolo)
             return True
         else:
             # Status code 2xx ma non 204? Improbabile per PUT ma gestiamolo.
@@ -463,13 +1123,25 @@ def update_article_alt_code(codice_articolo, new_alt_code):
 
     except requests.exceptions.Timeout:
         print(f"ERRORE [update_alt_code]: Timeout nella chiamata PUT a {full_url}")
+        _circuit_breaker.record_failure()
         return False
     except requests.exceptions.SSLError as e:
         print(f"ERRORE SSL [update_alt_code] nella chiamata PUT a {full_url}: {e}")
+        _circuit_breaker.record_failure()
+        return False
+    except requests.exceptions.ConnectionError as e:
+        print(f"ERRORE [update_alt_code]: Errore di connessione nella chiamata PUT a {full_url}: {e}")
+        _circuit_breaker.record_failure()
         return False
     except requests.exceptions.RequestException as e:
         error_details = "N/D"
         status_code = "N/A"
+        # Come in mx_call_api: 5xx/429 o nessuna risposta contano come guasto di Mexal,
+        # un 4xx è un errore applicativo e il server ha comunque risposto.
+        if e.response is None or e.response.status_code >= 500 or e.response.status_code == 429:
+            _circuit_breaker.record_failure()
+        else:
+            _circuit_breaker.record_success()
         if e.response is not None:
              status_code = e.response.status_code
              try: error_details = e.response.json() # Prova a leggere JSON
@@ -480,6 +1152,10 @@ def update_article_alt_code(codice_articolo, new_alt_code):
     except Exception as e:
          print(f"ERRORE inaspettato in [update_alt_code] per {codice_articolo}: {e}")
          return False
+    finally:
+        _record_call(endpoint, time.perf_counter() - started,
+                     len(response.content or b'') if response is not None else 0,
+                     error=response is None or response.status_code != 204)
     
 def get_all_clients():
     """Recupera l'elenco completo dei clienti dall'API."""
@@ -511,7 +1187,7 @@ def get_all_shipping_addresses():
     """
     endpoint = 'risorse/indirizzi-spedizione/ricerca'
     # Richiediamo campi utili per l'elenco
-    fields = "id,cod_conto,descrizione,indirizzo,localita,cap,provincia"
+    fields = "id,cod_conto,descrizione,indirizzo,localita,cap,provincia,telefono1,nazione"
     endpoint += f"?fields={fields}"
     payload = {'filtri': []} # Nessun filtro = tutti
 
@@ -529,6 +1205,29 @@ def get_all_shipping_addresses():
         return None
 # --- FINE NUOVA FUNZIONE ---
 
+def get_shipping_address_map(cod_conti=None):
+    """
+    Recupera tutti gli indirizzi di spedizione con UNA chiamata e li indicizza per ID;
+    con cod_conti solo quelli di questi clienti (ricerca 'in' su cod_conto).
+    Le chiavi sono stringhe (l'ID in 'cod_anag_sped' può arrivare come numero o testo).
+    Restituisce None se la chiamata API fallisce.
+    """
+    if cod_conti is None:
+        addresses = get_all_shipping_addresses()
+    else:
+        try:
+            addresses = list(mx_iter_search_in('risorse/indirizzi-spedizione/ricerca', 'cod_conto', cod_conti,
+                                               fields=SHIPPING_ADDRESS_FIELDS))
+        except MexalAPIError as e:
+            print(f"ERRORE [get_shipping_address_map]: {e}")
+            addresses = None
+    if addresses is None:
+        return None
+    return {
+        str(addr['id']): addr
+        for addr in addresses if isinstance(addr, dict) and addr.get('id') is not None
+    }
+
 
 # --- Funzione ESISTENTE (ottiene 1 indirizzo per ID, la manteniamo se serve altrove) ---
 def get_shipping_address(address_id):
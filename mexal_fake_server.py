@@ -0,0 +1,340 @@
+# mexal_fake_server.py
+"""
+Server Mexal "finto" per sviluppo, benchmark e test di carico senza l'ERP reale.
+
+Espone le stesse risorse 'risorse/...' e 'servizi' usate da mexal_api.py, con
+supporto a 'filtri', '?fields=', paginazione ('max' / 'next') e 'data_ult_mod',
+su un dataset sintetico di dimensione configurabile e con latenza simulata.
+
+Uso tipico:
+    python mexal_fake_server.py --orders 400 --latency-ms 80 --port 9004
+    MX_API_BASE_URL=http://localhost:9004/webapi/ MX_AUTH=fake python app.py
+
+Il dataset può essere salvato e ricaricato per benchmark riproducibili:
+    python mexal_fake_server.py --dump fixtures.json          # genera, salva ed esce
+    python mexal_fake_server.py --fixtures fixtures.json      # serve i dati registrati
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+# Latenza simulata per chiamata (millisecondi) e jitter casuale
+FAKE_LATENCY_MS = int(os.getenv('FAKE_MX_LATENCY_MS', '0'))
+FAKE_JITTER_MS = int(os.getenv('FAKE_MX_JITTER_MS', '0'))
+
+GRUPPI_MERC = ['01-PESCE', '01-CEFALOPODI', '01-CROSTACEI', '01-FRUTTI MARE', '01-OSTRICHE',
+               '02-RISO', '03-ALGHE', '04-SALSA-SOIA', '05-DESSERT-GELO', '04-SURIMI-GRANCH', '09-BIRRA']
+PAROLE_ARTICOLI = ['SALMONE', 'TONNO', 'GAMBERO', 'RISO', 'ALGA', 'NORI', 'SOIA', 'WASABI', 'ZENZERO',
+                   'POLPO', 'CALAMARO', 'OSTRICA', 'EDAMAME', 'MOCHI', 'BIRRA', 'SAKE', 'SURIMI', 'TOBIKO']
+LOCALITA = ['NAPOLI', 'SALERNO', 'SCAFATI', 'POMPEI', 'CASERTA', 'AVELLINO', 'SORRENTO', 'NOCERA INFERIORE']
+
+_dataset = {}
+_dataset_lock = threading.Lock()
+_stats = {'calls': 0}
+
+
+# --- Generazione dataset sintetico ---
+
+def _mexal_timestamp(dt):
+    """Formato usato da Mexal per 'data_ult_mod' (confrontabile come stringa)."""
+    return dt.strftime('%Y%m%d %H%M%S')
+
+def generate_dataset(n_clients=200, n_addresses=150, n_orders=300, rows_per_order=8,
+                     n_articles=1500, days=14, seed=42):
+    """Crea un dataset coerente: clienti, indirizzi, articoli, ordini e righe."""
+    rnd = random.Random(seed)
+    now = datetime.now()
+
+    clients = []
+    for i in range(1, n_clients + 1):
+        clients.append({
+            'codice': f"501.{i:05d}",
+            'ragione_sociale': f"RISTORANTE {rnd.choice(PAROLE_ARTICOLI)} {i}",
+            'telefono': f"081{rnd.randint(1000000, 9999999)}",
+            'indirizzo': f"VIA ROMA {rnd.randint(1, 200)}",
+            'localita': rnd.choice(LOCALITA),
+            'cap': f"84{rnd.randint(100, 999)}",
+            'provincia': 'SA',
+            'data_ult_mod': _mexal_timestamp(now - timedelta(days=rnd.randint(1, 300)))
+        })
+
+    addresses = []
+    for i in range(1, n_addresses + 1):
+        client = rnd.choice(clients)
+        addresses.append({
+            'id': i,
+            'cod_conto': client['codice'],
+            'descrizione': f"SEDE {i}",
+            'indirizzo': f"CORSO ITALIA {rnd.randint(1, 300)}",
+            'localita': rnd.choice(LOCALITA),
+            'cap': f"80{rnd.randint(100, 999)}",
+            'provincia': 'NA',
+            'telefono1': f"339{rnd.randint(1000000, 9999999)}",
+            'nazione': 'IT'
+        })
+
+    dati_aggiuntivi = {
+        c['codice']: {'orario1start': f"{rnd.randint(8, 11):02d}:00", 'orario1end': f"{rnd.randint(12, 15):02d}:30"}
+        for c in clients
+    }
+
+    articles = []
+    for i in range(1, n_articles + 1):
+        word = rnd.choice(PAROLE_ARTICOLI)
+        articles.append({
+            'codice': f"ART{i:05d}",
+            'descrizione': f"{word} {rnd.choice(['FRESCO', 'SURGELATO', 'KG 1', 'PZ 10', 'BOX'])} {i}",
+            'descr_completa': f"{word} articolo sintetico numero {i}",
+            'cod_alternativo': f"80{i:011d}",
+            'cod_grp_merc': rnd.choice(GRUPPI_MERC),
+            'qta_carico': rnd.randint(0, 500),
+            'qta_scarico': rnd.randint(0, 300),
+            'ord_cli_e': rnd.randint(0, 20),
+            'ord_cli_sps': rnd.randint(0, 10),
+            'prezzo': round(rnd.uniform(1, 80), 2),
+            'data_ult_mod': _mexal_timestamp(now - timedelta(days=rnd.randint(1, 300)))
+        })
+
+    orders, rows = [], []
+    row_id = 1
+    for numero in range(1, n_orders + 1):
+        client = rnd.choice(clients)
+        client_addresses = [a for a in addresses if a['cod_conto'] == client['codice']]
+        doc_date = now - timedelta(days=rnd.randint(0, days - 1))
+        orders.append({
+            'sigla': 'OC', 'serie': 1, 'numero': numero,
+            'data_documento': doc_date.strftime('%Y%m%d'),
+            'cod_conto': client['codice'],
+            'cod_anag_sped': rnd.choice(client_addresses)['id'] if client_addresses and rnd.random() < 0.5 else None,
+            'id_pagamento': rnd.randint(1, 5),
+            'nota': '',
+            'data_ult_mod': _mexal_timestamp(doc_date)
+        })
+        for article in rnd.sample(articles, min(rows_per_order, len(articles))):
+            rows.append({
+                'sigla': 'OC', 'serie': 1, 'numero': numero,
+                'id_riga': row_id,
+                'codice_articolo': article['codice'],
+                'descr_articolo': article['descrizione'],
+                'nr_colli': rnd.randint(1, 6),
+                'quantita': rnd.choice([1, 5, 10, 12]),
+                'data_ult_mod': _mexal_timestamp(doc_date)
+            })
+            row_id += 1
+
+    return {
+        'clienti': clients,
+        'fornitori': [
+            {'codice': '601.00001', 'ragione_sociale': 'BOXER'},
+            {'codice': '601.00002', 'ragione_sociale': 'EXPERT'},
+            {'codice': '601.00003', 'ragione_sociale': 'FORNITORE ITTICO SRL'},
+        ],
+        'indirizzi-spedizione': addresses,
+        'pagamenti': [{'id': i, 'descrizione': d} for i, d in
+                      enumerate(['RIMESSA DIRETTA', 'BONIFICO 30GG', 'RIBA 60GG', 'CONTANTI', 'ASSEGNO'], start=1)],
+        'ordini-clienti': orders,
+        'righe': rows,
+        'articoli': articles,
+        'dati-aggiuntivi': dati_aggiuntivi
+    }
+
+
+# --- Semantica delle ricerche Mexal ---
+
+def _matches(record, filtro):
+    campo = filtro.get('campo')
+    condizione = filtro.get('condizione', '=')
+    valore = filtro.get('valore')
+    attuale = record.get(campo)
+    if attuale is None:
+        return False
+
+    if filtro.get('case_insensitive') and isinstance(valore, str):
+        attuale, valore = str(attuale).lower(), valore.lower()
+
+    if condizione == 'contiene':
+        return str(valore) in str(attuale)
+    if condizione == 'in':
+        valori = valore if isinstance(valore, list) else str(valore).split(',')
+        return str(attuale) in {str(v) for v in valori}
+
+    # Confronti: numerici se possibile, altrimenti come stringhe (date Mexal)
+    try:
+        a, v = float(attuale), float(valore)
+    except (TypeError, ValueError):
+        a, v = str(attuale), str(valore)
+    return {
+        '=': a == v, '<>': a != v, '>': a > v, '>=': a >= v, '<': a < v, '<=': a <= v
+    }.get(condizione, False)
+
+def _project(record, fields):
+    if not fields:
+        return dict(record)
+    return {f: record.get(f) for f in fields if f in record}
+
+def _search(collection):
+    """Applica filtri, proiezione e paginazione a una collezione del dataset."""
+    body = request.get_json(silent=True) or {}
+    filtri = body.get('filtri') or []
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+
+    with _dataset_lock:
+        records = [r for r in _dataset.get(collection, []) if all(_matches(r, f) for f in filtri)]
+
+    page_size = request.args.get('max', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    response = {}
+    if page_size:
+        page = records[offset:offset + page_size]
+        if offset + page_size < len(records):
+            args = request.args.to_dict()
+            args['offset'] = str(offset + page_size)
+            query = '&'.join(f"{k}={v}" for k, v in args.items())
+            response['next'] = f"{request.host_url.rstrip('/')}{request.path}?{query}"
+    else:
+        page = records
+
+    response['dati'] = [_project(r, fields) for r in page]
+    return jsonify(response)
+
+
+@app.before_request
+def _simulate_latency_and_auth():
+    if not request.path.startswith('/webapi/'):
+        return None
+    if not request.headers.get('Authorization', '').startswith('Passepartout'):
+        return jsonify({'error': 'Autenticazione mancante'}), 401
+    _stats['calls'] += 1
+    if FAKE_LATENCY_MS or FAKE_JITTER_MS:
+        time.sleep((FAKE_LATENCY_MS + random.uniform(0, FAKE_JITTER_MS)) / 1000.0)
+    return None
+
+
+SEARCH_COLLECTIONS = {
+    'risorse/clienti/ricerca': 'clienti',
+    'risorse/fornitori/ricerca': 'fornitori',
+    'risorse/indirizzi-spedizione/ricerca': 'indirizzi-spedizione',
+    'risorse/dati-generali/pagamenti/ricerca': 'pagamenti',
+    'risorse/documenti/ordini-clienti/ricerca': 'ordini-clienti',
+    'risorse/documenti/ordini-clienti/righe/ricerca': 'righe',
+    'risorse/articoli/ricerca': 'articoli',
+}
+
+for _path, _collection in SEARCH_COLLECTIONS.items():
+    app.add_url_rule(f'/webapi/{_path}', endpoint=f'search_{_collection}', methods=['POST'],
+                     view_func=lambda c=_collection: _search(c))
+
+
+@app.route('/webapi/risorse/clienti/<path:client_code>/dati-aggiuntivi', methods=['GET'])
+def dati_aggiuntivi(client_code):
+    if request.args.get('encoding') == 'hex':
+        client_code = bytes.fromhex(client_code).decode('utf-8')
+    with _dataset_lock:
+        dati = _dataset['dati-aggiuntivi'].get(client_code)
+    if dati is None:
+        return jsonify({'error': f"Cliente {client_code} non trovato"}), 404
+    return jsonify({'dati': dati})
+
+
+@app.route('/webapi/risorse/articoli/<codice>', methods=['GET', 'PUT'])
+def articolo(codice):
+    with _dataset_lock:
+        article = next((a for a in _dataset['articoli'] if a['codice'] == codice), None)
+        if article is None:
+            return jsonify({'error': f"Articolo {codice} non trovato"}), 404
+        if request.method == 'PUT':
+            article.update(request.get_json(silent=True) or {})
+            article['data_ult_mod'] = _mexal_timestamp(datetime.now())
+            return '', 204
+        return jsonify(dict(article))
+
+
+@app.route('/webapi/servizi', methods=['POST'])
+def servizi():
+    body = request.get_json(silent=True) or {}
+    if body.get('cmd') != 'condizioni_documento':
+        return jsonify({'error': f"Servizio {body.get('cmd')} non supportato"}), 400
+    codice = (body.get('dati') or {}).get('codice_articolo')
+    with _dataset_lock:
+        article = next((a for a in _dataset['articoli'] if a['codice'] == codice), None)
+    return jsonify({'prezzo': article['prezzo'] if article else 0.0, 'sconto': '', 'provvigione': ''})
+
+
+# --- Rotte di controllo (non Mexal) per simulare modifiche e leggere statistiche ---
+
+@app.route('/_fake/touch', methods=['POST'])
+def touch_orders():
+    """Marca come modificati N ordini a caso (e le loro righe), per provare il polling."""
+    n = request.args.get('n', 1, type=int)
+    now = _mexal_timestamp(datetime.now())
+    with _dataset_lock:
+        touched = random.sample(_dataset['ordini-clienti'], min(n, len(_dataset['ordini-clienti'])))
+        keys = set()
+        for order in touched:
+            order['data_ult_mod'] = now
+            keys.add((order['sigla'], order['serie'], order['numero']))
+        for row in _dataset['righe']:
+            if (row['sigla'], row['serie'], row['numero']) in keys:
+                row['data_ult_mod'] = now
+    return jsonify({'touched': [f"{s}:{se}:{n}" for s, se, n in sorted(keys)]})
+
+
+@app.route('/_fake/stats')
+def fake_stats():
+    with _dataset_lock:
+        sizes = {k: len(v) for k, v in _dataset.items()}
+    return jsonify({'calls': _stats['calls'], 'dataset': sizes})
+
+
+def main():
+    global FAKE_LATENCY_MS, FAKE_JITTER_MS, _dataset
+
+    parser = argparse.ArgumentParser(description="Server Mexal finto per sviluppo e benchmark.")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--addresses', type=int, default=150)
+    parser.add_argument('--orders', type=int, default=300)
+    parser.add_argument('--rows-per-order', type=int, default=8)
+    parser.add_argument('--articles', type=int, default=1500)
+    parser.add_argument('--days', type=int, default=14, help="Giorni coperti dalle date documento")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency-ms', type=int, default=FAKE_LATENCY_MS)
+    parser.add_argument('--jitter-ms', type=int, default=FAKE_JITTER_MS)
+    parser.add_argument('--fixtures', help="Carica il dataset da un file JSON registrato")
+    parser.add_argument('--dump', help="Salva il dataset generato in un file JSON ed esce")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9004)
+    args = parser.parse_args()
+
+    FAKE_LATENCY_MS, FAKE_JITTER_MS = args.latency_ms, args.jitter_ms
+
+    if args.fixtures:
+        with open(args.fixtures, encoding='utf-8') as f:
+            _dataset = json.load(f)
+        print(f"Dataset caricato da {args.fixtures}.")
+    else:
+        _dataset = generate_dataset(args.clients, args.addresses, args.orders, args.rows_per_order,
+                                    args.articles, args.days, args.seed)
+
+    if args.dump:
+        with open(args.dump, 'w', encoding='utf-8') as f:
+            json.dump(_dataset, f, ensure_ascii=False)
+        print(f"Dataset salvato in {args.dump}.")
+        return
+
+    print(f"Dataset: { {k: len(v) for k, v in _dataset.items()} }")
+    print(f"Latenza simulata: {FAKE_LATENCY_MS}ms (+ jitter {FAKE_JITTER_MS}ms)")
+    print(f"Imposta MX_API_BASE_URL=http://{args.host}:{args.port}/webapi/ per usarlo con l'app.")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()